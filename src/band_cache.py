@@ -0,0 +1,107 @@
+"""
+BandCache keeps the spectral bands of a scene open and decoded so that
+building several products from the same date only decodes each band once.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import rasterio
+from rasterio.enums import Resampling
+
+# Default number of bytes of decoded bands kept in memory
+CACHE_BYTES = 2 * 1024 ** 3
+
+
+class BandCache():
+    """
+    Per scene cache owning the dataset handles of the bands and their decoded
+    arrays. Arrays are evicted least recently used first once their total
+    size goes over max_bytes.
+    """
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.readers = {}
+        self.arrays = OrderedDict()
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_reader(self, filepath):
+        """
+        Returns the opened dataset of a band, opening it the first time.
+        """
+        if filepath not in self.readers:
+            driver = None
+            if filepath.lower().endswith('.jp2'):
+                driver = 'JP2OpenJPEG'
+            self.readers[filepath] = rasterio.open(filepath, driver=driver)
+
+        return self.readers[filepath]
+
+    def read(self, filepath, band=1, window=None, out_shape=None,
+             resampling=Resampling.nearest):
+        """
+        Returns the decoded band, or a window of it, from the cache or from
+        the file when it isn't cached yet. The returned array is read only
+        since it is shared with later callers.
+        out_shape: (height, width) the data is resampled to while decoding
+        """
+        key = (filepath, band, None if window is None else window.flatten(),
+               out_shape, resampling)
+        if key in self.arrays:
+            self.arrays.move_to_end(key)
+            return self.arrays[key]
+
+        data = self.get_reader(filepath).read(band, window=window,
+                                              out_shape=out_shape,
+                                              resampling=resampling)
+        data.flags.writeable = False
+        self.add(key, data)
+        return data
+
+    def add(self, key, data):
+        """
+        Caches an array and evicts the least recently used ones until the
+        cache fits in its budget. Arrays bigger than the budget are not kept.
+        """
+        if data.nbytes > self.max_bytes:
+            return
+
+        self.arrays[key] = data
+        self.size += data.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self.arrays.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def clear(self):
+        """
+        Drops every decoded array but keeps the datasets open.
+        """
+        self.arrays.clear()
+        self.size = 0
+
+    def close(self):
+        """
+        Drops every decoded array and closes the datasets.
+        """
+        self.clear()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+
+@contextmanager
+def scene_cache(cache=None):
+    """
+    Yields the given cache, or a temporary one closed on exit when no cache
+    is given.
+    """
+    if cache is not None:
+        yield cache
+        return
+
+    with BandCache() as new_cache:
+        yield new_cache
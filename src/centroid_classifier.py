@@ -0,0 +1,110 @@
+"""
+CentroidClassifier labels every pixel of a raster with the class of its
+nearest centroid, streaming the raster tile by tile so that whole scenes are
+classified in constant memory.
+"""
+import numpy as np
+import gdal
+from raster_data import RasterData
+from preprocessing import TILE_SIZE
+
+# Number of pixels whose distances to the centroids are computed at once
+BLOCK_PIXELS = 65536
+
+# Creation options of the label images
+OUTPUT_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'BLOCKXSIZE=512',
+                  'BLOCKYSIZE=512']
+
+
+class CentroidClassifier():
+    """
+    Nearest centroid classifier working in float32 on blocks of pixels.
+    """
+    def __init__(self, centroids, classes=None):
+        """
+        centroids: (classes, bands) array, one centroid per class
+        classes: label of each centroid, from 0 to the number of centroids
+                 if None. Labels must fit in an unsigned byte
+        """
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        if classes is None:
+            classes = np.arange(len(self.centroids))
+        self.classes = np.asarray(classes).astype(np.uint8)
+        self.squared_norms = np.square(self.centroids).sum(axis=1)
+
+    @classmethod
+    def from_samples(cls, samples, classes=None):
+        """
+        Builds the classifier from the labelled samples of each class, such
+        as the .npy files of the labelled data notebook.
+        samples: list of (pixels, bands) arrays, one per class
+        classes: label of each class, from 0 if None
+        """
+        centroids = [np.mean(sample, axis=0, dtype=np.float64)
+                     for sample in samples]
+        return cls(centroids, classes)
+
+    @classmethod
+    def from_nearest_centroid(cls, classifier):
+        """
+        Builds the classifier from a fitted sklearn NearestCentroid.
+        """
+        return cls(classifier.centroids_, classifier.classes_)
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Loads a classifier saved with save.
+        """
+        with np.load(filepath) as saved:
+            return cls(saved['centroids'], saved['classes'])
+
+    def save(self, filepath):
+        """
+        Saves the centroids and their labels to a .npz file.
+        """
+        np.savez(filepath, centroids=self.centroids, classes=self.classes)
+
+    def predict(self, features, block_pixels=BLOCK_PIXELS):
+        """
+        Returns the label of the nearest centroid of every pixel of the
+        (pixels, bands) features. Squared distances are expanded as
+        |x|^2 - 2x.c + |c|^2, |x|^2 being the same for every centroid it is
+        left out of the comparison.
+        """
+        labels = np.empty(len(features), dtype=np.uint8)
+        for start in range(0, len(features), block_pixels):
+            block = np.asarray(features[start:start + block_pixels],
+                               dtype=np.float32)
+            distances = block @ self.centroids.T
+            distances *= -2
+            distances += self.squared_norms
+            labels[start:start + block_pixels] = self.classes[
+                np.argmin(distances, axis=1)]
+
+        return labels
+
+    def classify_raster(self, image_path, output_path, bands=None,
+                        tile_size=TILE_SIZE):
+        """
+        Classifies the raster tile by tile and writes the labels to a uint8
+        GeoTIFF georeferenced like the raster.
+        bands: band numbers or descriptions used as features, all if None
+        """
+        data = RasterData(image_path, bands=bands)
+        raster_data = gdal.Open(image_path)
+        tiff_driver = gdal.GetDriverByName('GTiff')
+        output_data = tiff_driver.Create(output_path, data.width, data.height,
+                                         1, gdal.GDT_Byte, OUTPUT_OPTIONS)
+        output_data.SetGeoTransform(raster_data.GetGeoTransform())
+        output_data.SetProjection(raster_data.GetProjection())
+
+        out_band = output_data.GetRasterBand(1)
+        for window, _, features in data.iterate_blocks(
+                dtype=np.float32, flatten=True, tile_size=tile_size):
+            labels = self.predict(features)
+            out_band.WriteArray(labels.reshape(window.height, window.width),
+                                window.x_off, window.y_off)
+
+        output_data.FlushCache()
+        return output_path
@@ -2,70 +2,238 @@
 CLASSIFICATION FILE, USED TO ADD CLUSTERING TO IMAGES
 """
 import os
-from sklearn.cluster import KMeans, DBSCAN
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans, DBSCAN
+from sklearn.metrics import silhouette_score
 from sklearn.mixture import GaussianMixture
+from sklearn.neighbors import NearestNeighbors
 import numpy as np
 import matplotlib.pyplot as plt
 import gdal
+import joblib
 from raster_data import RasterData
+from preprocessing import get_band_statistics, standardize
+from preprocessing import sample_pixels, compress_pixels, resample_weighted
+from preprocessing import TILE_SIZE
 from logger import Logger
 
+# Standard deviation of the gaussian blur applied before normalized kmeans
+KMEANS_SIGMA = 5
 
-def plot_cost_function(project, image_type='rgb',
-                       cropped=True, normalized=True):
+# Folder of the clustering folder fitted models are saved to
+MODELS_FOLDER = '.models'
+
+# Number of consecutive K a worker of a warm started sweep fits in sequence
+SWEEP_CHUNK_SIZE = 4
+
+# Number of pixels sampled across the scene to initialize the streaming
+# kmeans centroids
+STREAMING_SAMPLE_SIZE = 100000
+
+# Number of pixels drawn from the deduplicated pixels to fit a gmm, which
+# doesn't accept sample weights, when no sample size is given
+WEIGHTED_SAMPLE_SIZE = 1000000
+
+
+def plot_cost_function(project, image_type='rgb', cropped=True,
+                       normalized=True, kval=range(2, 16), workers=None):
     """
-    plots the cost function for different numbers of clusters
+    plots the cost function for different numbers of clusters, along with
+    the silhouette score and the detected elbow
+    kval: numbers of clusters swept, see kmeans_sweep
+    workers: number of processes fitting the models
     """
     log = Logger()
 
     image_path, date = project.get_image_paths(image_type,
                                                cropped, get_date=True)
-    data = RasterData(image_path)
+    data = RasterData(image_path, memmap=True)
     if normalized:
-        data.standard_normalize_array(inplace=True)
-
-    kval = range(2, 5)
-    costs = []
-    for k in kval:
-        kmeans_model = KMeans(n_clusters=k, random_state=0)
-        prediction = kmeans_model.fit_predict(data.flatten_array())
-
-        results = list(np.unique(prediction,return_counts=True)[1])
-        list.sort(results)
-        costs.append(kmeans_model.inertia_)
+        data.array = data.pipeline().normalize().to_array()
 
+    sweep = kmeans_sweep(data.flatten_array(), kval, workers=workers)
+    for k, cost, counts in zip(sweep['k'], sweep['inertia'],
+                               sweep['counts']):
         log.log(project.project_name, date, image_type, k, cropped, normalized,
-                'kmeans', kmeans_model.inertia_, str(results))
+                'kmeans', cost, str(sorted(counts)))
         log.push_information()
 
-    plt.plot(kval, costs)
-    plt.xticks(kval)
+    elbow = sweep['k'].index(sweep['elbow'])
+    log.log(project.project_name, date, image_type, sweep['elbow'], cropped,
+            normalized, 'kmeans elbow', sweep['inertia'][elbow],
+            sweep['silhouette'][elbow])
+    log.push_information()
+
+    _, cost_axis = plt.subplots()
+    cost_axis.plot(sweep['k'], sweep['inertia'])
+    cost_axis.axvline(sweep['elbow'], color='grey', linestyle='--')
+    cost_axis.set_xticks(sweep['k'])
+    cost_axis.set_xlabel('K')
+    cost_axis.set_ylabel('cost')
+    silhouette_axis = cost_axis.twinx()
+    silhouette_axis.plot(sweep['k'], sweep['silhouette'], color='tab:orange')
+    silhouette_axis.set_ylabel('silhouette')
     plt.title('K-means cost across K using {} image'.format
               (image_type))
-    plt.xlabel('K')
-    plt.ylabel('cost')
     plt.show()
 
 
-def save_output_result(prediction, project, image_path,
-                       output_description, cropped):
+def kmeans_sweep(features, kval=range(2, 16), workers=None, warm_start=False,
+                 fit_size=100000, sample_size=10000, n_init=4,
+                 random_state=0):
     """
-    Saves The clustering result to a new image
+    Fits a kmeans model for every number of clusters in kval. The features
+    are written once to a temporary .npy file that every worker process maps
+    read only, the sorted kval is split in one contiguous chunk per worker.
+    Every model is fitted on the same random sample of the pixels, its
+    inertia and cluster sizes are then computed over every pixel, a chunk
+    of the map at a time.
+    Returns a dict with the k, inertia, silhouette and cluster sizes of each
+    fit and the elbow of the cost curve.
+    features: (pixels, bands) array
+    workers: number of processes, at most one per cpu when None. There is
+             one per k, or one per SWEEP_CHUNK_SIZE k if warm starting
+    warm_start: if true each fit of a chunk also starts from the centroids
+                of the previous k, completed with the farthest sampled
+                pixels. The k of a chunk are fitted one after the other so
+                the sweep is slower on a machine with a cpu per k
+    fit_size: number of pixels the models are fitted on
+    sample_size: number of pixels the silhouette score is computed on
+    n_init: number of initializations of each fit, the best one is kept.
+            A warm start replaces one of them
+    """
+    kval = sorted(kval)
+    if workers is None:
+        workers = len(kval)
+        if warm_start:
+            workers = -(-len(kval) // SWEEP_CHUNK_SIZE)
+        workers = min(workers, os.cpu_count() or 1)
+    workers = min(workers, len(kval))
+
+    descriptor, features_path = tempfile.mkstemp(suffix='.npy')
+    os.close(descriptor)
+    try:
+        np.save(features_path, features)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(
+                __fit_sweep_chunk, [features_path] * workers,
+                [list(chunk) for chunk in np.array_split(kval, workers)],
+                [warm_start] * workers, [fit_size] * workers,
+                [sample_size] * workers, [n_init] * workers,
+                [random_state] * workers)
+            fits = [fit for chunk in chunks for fit in chunk]
+    finally:
+        os.remove(features_path)
+
+    sweep = {'k': kval,
+             'inertia': [fit[0] for fit in fits],
+             'silhouette': [fit[1] for fit in fits],
+             'counts': [fit[2] for fit in fits]}
+    sweep['elbow'] = find_elbow(kval, sweep['inertia'])
+    return sweep
+
+
+def __fit_sweep_chunk(features_path, kval, warm_start, fit_size,
+                      sample_size, n_init, random_state):
+    """
+    Fits the models of one chunk of a sweep in a worker process and returns
+    the (inertia, silhouette, cluster sizes) of each of them. The random
+    samples are the same in every worker.
+    """
+    features = np.load(features_path, mmap_mode='r')
+    rng = np.random.default_rng(random_state)
+    fit_data = features[np.sort(rng.choice(
+        len(features), min(fit_size, len(features)), replace=False))]
+    sample = fit_data[np.sort(rng.choice(
+        len(fit_data), min(sample_size, len(fit_data)), replace=False))]
+
+    fits = []
+    centers = None
+    for k in kval:
+        k = int(k)
+        candidates = []
+        if warm_start and centers is not None:
+            candidates.append(KMeans(
+                n_clusters=k, n_init=1,
+                init=__extend_centers(centers, sample, k)))
+        if n_init > len(candidates):
+            candidates.append(KMeans(n_clusters=k,
+                                     n_init=n_init - len(candidates),
+                                     random_state=random_state))
+        model = min((candidate.fit(fit_data) for candidate in candidates),
+                    key=lambda candidate: candidate.inertia_)
+        centers = model.cluster_centers_
+
+        inertia = 0
+        counts = np.zeros(k, dtype=np.int64)
+        for start in range(0, len(features), TILE_SIZE ** 2):
+            distances = model.transform(np.asarray(
+                features[start:start + TILE_SIZE ** 2], dtype=fit_data.dtype))
+            labels = distances.argmin(axis=1)
+            inertia += np.square(
+                distances[np.arange(len(labels)), labels]).sum()
+            counts += np.bincount(labels, minlength=k)
+
+        labels = model.predict(sample)
+        silhouette = np.nan
+        if len(np.unique(labels)) > 1:
+            silhouette = silhouette_score(sample, labels)
+        fits.append((inertia, silhouette, counts.tolist()))
+
+    return fits
+
+
+def __extend_centers(centers, sample, clusters):
+    """
+    Adds to the centroids the sampled pixels farthest from them, one at a
+    time, until there are as many as clusters.
+    """
+    distances = ((sample[:, None, :] - centers[None]) ** 2).sum(axis=2)
+    distances = distances.min(axis=1)
+    while len(centers) < clusters:
+        farthest = sample[np.argmax(distances)]
+        centers = np.vstack([centers, farthest])
+        distances = np.minimum(distances,
+                               ((sample - farthest) ** 2).sum(axis=1))
+    return centers
+
+
+def find_elbow(kval, costs):
+    """
+    Returns the k of the cost curve farthest from the chord joining its
+    first and last points, both axes being scaled to [0, 1].
+    """
+    kval = np.asarray(kval, dtype=np.float64)
+    costs = np.asarray(costs, dtype=np.float64)
+    if len(kval) < 3:
+        return int(kval[0])
+
+    x = (kval - kval[0]) / (kval[-1] - kval[0])
+    y = (costs - costs.min()) / max(costs.max() - costs.min(), 1e-12)
+    chord = np.array([x[-1] - x[0], y[-1] - y[0]])
+    chord /= np.linalg.norm(chord)
+    distances = np.abs((x - x[0]) * chord[1] - (y - y[0]) * chord[0])
+    return int(kval[np.argmax(distances)])
+
+
+def create_output_raster(project, image_path, output_description, cropped):
+    """
+    Creates the empty single band image a clustering result of the image
+    is written to, georeferenced like the image.
     """
     tiff_driver = gdal.GetDriverByName('GTiff')
     raster_data = gdal.Open(image_path)
-    out_data = prediction.reshape((raster_data.RasterYSize,
-                                  raster_data.RasterXSize))
 
     date = 0
     output_path = ''
     if cropped:
         date = image_path.split(os.sep)[-3]
-        output_path = (project.get_classification_folder_path() + date +
+        output_path = (project.get_clustering_folder_path() + date +
                        os.sep + 'cropped' + os.sep + output_description)
     else:
         date = image_path.split(os.sep)[-2]
-        output_path = (project.get_classification_folder_path() + date +
+        output_path = (project.get_clustering_folder_path() + date +
                        os.sep + output_description)
 
     # save the original image with gdal
@@ -73,94 +241,481 @@ def save_output_result(prediction, project, image_path,
                                      raster_data.RasterXSize,
                                      raster_data.RasterYSize,
                                      1, gdal.GDT_Float32)
+    output_data.SetGeoTransform(raster_data.GetGeoTransform())
+    output_data.SetProjection(raster_data.GetProjection())
+    return output_data
+
 
+def save_output_result(prediction, project, image_path,
+                       output_description, cropped):
+    """
+    Saves The clustering result to a new image
+    """
+    output_data = create_output_raster(project, image_path,
+                                       output_description, cropped)
+    out_data = prediction.reshape((output_data.RasterYSize,
+                                  output_data.RasterXSize))
     output_data.GetRasterBand(1).WriteArray(out_data)
+    output_data.FlushCache()
+
+
+def get_model_path(project, image_type, normalized, algorithm, clusters,
+                   bands=None, deduplicate=False, sigma=0):
+    """
+    Returns the path a fitted model of the project is saved to.
+    bands: band numbers or descriptions the model was fitted on, all if None
+    deduplicate: if true the path of a model fitted on deduplicated pixels
+    sigma: standard deviation of the blur applied to the features
+    """
+    name = '{}_{}_{}_{}_{}'.format(
+        project.project_name, image_type,
+        'normalized' if normalized else 'raw', algorithm, clusters)
+    if bands is not None:
+        name += '_b' + '-'.join(str(band) for band in bands)
+    if deduplicate:
+        name += '_dedup'
+    if sigma > 0:
+        name += '_sigma{}'.format(sigma)
+
+    return (project.get_clustering_folder_path() + MODELS_FOLDER + os.sep +
+            name + '.joblib')
+
+
+def get_blur_sigma(algorithm, normalized, deduplicate=False):
+    """
+    Returns the standard deviation of the blur kmeans_cluster applies to
+    the features of a model, 0 when they aren't blurred.
+    """
+    if normalized and not deduplicate and algorithm != 'gmm':
+        return KMEANS_SIGMA
+    return 0
+
+
+def save_model(model_path, model, statistics, sigma, output_path, dtype):
+    """
+    Saves a fitted model with what is needed to apply it to another date:
+    the band (mean, std) the features were standardized with, None when
+    they weren't, the blur sigma, the output file name and the features
+    dtype.
+    """
+    os.makedirs(os.path.dirname(model_path), exist_ok=True)
+    joblib.dump({'model': model, 'statistics': statistics, 'sigma': sigma,
+                 'output': output_path, 'dtype': np.dtype(dtype).name},
+                model_path)
+
+
+def load_model(model_path):
+    """
+    Returns a model saved with save_model, None if there is none.
+    """
+    if not os.path.exists(model_path):
+        return None
+    return joblib.load(model_path)
+
+
+def predict_in_tiles(predict, features, tile_pixels=TILE_SIZE ** 2,
+                     workers=None):
+    """
+    Applies predict to consecutive tiles of the (pixels, bands) features
+    in a thread pool and returns the labels of every pixel.
+    workers: number of threads, chosen by the executor if None
+    """
+    labels = np.empty(len(features), dtype=np.int64)
+
+    def assign(start):
+        labels[start:start + tile_pixels] = predict(
+            features[start:start + tile_pixels])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(assign, range(0, len(features), tile_pixels)))
+
+    return labels
+
+
+def get_core_sample_assigner(dbscan):
+    """
+    Returns a function labelling pixels with the cluster of their nearest
+    core sample of a fitted DBSCAN, pixels further than eps from every core
+    sample are noise (-1). The index of the core samples is built once and
+    shared by every call.
+    """
+    if len(dbscan.core_sample_indices_) == 0:
+        return lambda features: np.full(len(features), -1, dtype=np.int64)
+
+    core_labels = dbscan.labels_[dbscan.core_sample_indices_]
+    neighbors = NearestNeighbors(n_neighbors=1).fit(dbscan.components_)
+
+    def assign(features):
+        distances, indices = neighbors.kneighbors(features)
+        return np.where(distances[:, 0] <= dbscan.eps,
+                        core_labels[indices[:, 0]], -1)
+
+    return assign
+
+
+def iterate_features(data, normalized, sigma=0, tile_size=TILE_SIZE,
+                     statistics=None):
+    """
+    Returns an iterator of (window, features) over the tiles of the raster,
+    features being the (pixels, bands) float32 array the clustering works
+    on. When normalized each band is standardized with statistics of the
+    whole raster and blurred, tiles are read with a halo so that the blur
+    matches the one of the whole array.
+    statistics: band (mean, std) used instead of the raster's own ones
+    """
+    pipeline = data.pipeline()
+    if normalized:
+        pipeline.normalize(statistics)
+        if sigma > 0:
+            pipeline.blur(sigma)
+
+    return pipeline.iterate(tile_size, flatten=True)
+
+
+def kmeans_streaming(data, clusters, normalized, output_data,
+                     batch_size=4096, tile_size=TILE_SIZE, model=None,
+                     statistics=None, sigma=KMEANS_SIGMA,
+                     sample_size=STREAMING_SAMPLE_SIZE, passes=1):
+    """
+    Fits a mini-batch kmeans over the tiles of the raster then predicts the
+    labels tile by tile straight into the output image. Memory is bounded
+    by the tile size instead of the scene size. The centroids start from a
+    kmeans fitted on pixels sampled on a regular grid over the whole scene,
+    the pixels of each tile are shuffled before being split in batches.
+    Returns the model, its inertia over the scene and the cluster sizes.
+    model: already fitted model, only used to predict when given
+    statistics: band (mean, std) used to standardize the features
+    sigma: standard deviation of the blur applied to normalized features
+    sample_size: number of pixels the initial centroids are computed from
+    passes: number of passes over the scene the centroids are updated in
+    """
+    sigma = sigma if normalized else 0
+    kmeans_model = model
+    if kmeans_model is None:
+        scene_pixels = data.height * data.width
+        sample = []
+        for window, features in iterate_features(data, normalized, sigma,
+                                                 tile_size, statistics):
+            sample.append(sample_pixels(
+                features.reshape(window.height, window.width, -1),
+                max(1, sample_size * len(features) // scene_pixels)))
+        init = KMeans(n_clusters=clusters, random_state=0).fit(
+            np.concatenate(sample)).cluster_centers_
+
+        # Tiles hold few of the clusters, centroids missing from a batch
+        # must not be reassigned to its pixels
+        kmeans_model = MiniBatchKMeans(n_clusters=clusters, init=init,
+                                       n_init=1, batch_size=batch_size,
+                                       reassignment_ratio=0, random_state=0)
+        rng = np.random.default_rng(0)
+        for _ in range(passes):
+            for _, features in iterate_features(data, normalized, sigma,
+                                                tile_size, statistics):
+                features = features[rng.permutation(len(features))]
+                for start in range(0, len(features), batch_size):
+                    batch = features[start:start + batch_size]
+                    if len(batch) >= clusters:
+                        kmeans_model.partial_fit(batch)
+
+    inertia = 0
+    counts = np.zeros(clusters, dtype=np.int64)
+    out_band = output_data.GetRasterBand(1)
+    for window, features in iterate_features(data, normalized, sigma,
+                                             tile_size, statistics):
+        prediction = kmeans_model.predict(features)
+        inertia -= kmeans_model.score(features)
+        counts += np.bincount(prediction, minlength=clusters)
+        out_band.WriteArray(
+            prediction.reshape(window.height, window.width).astype(
+                np.float32), window.x_off, window.y_off)
+
+    output_data.FlushCache()
+    return kmeans_model, inertia, counts
 
 
 def kmeans_cluster(project, clusters, image_type='allbands',
-                   cropped=True, normalized=True):
+                   cropped=True, normalized=True, bands=None,
+                   streaming=False, tile_size=TILE_SIZE, sample_size=None,
+                   sampling='uniform', deduplicate=False, refit=False):
     """
     Clusters geotiff image using kmeans
+    bands: band numbers or descriptions used as features, all if None
+    streaming: if true a mini-batch kmeans is fitted and applied tile by
+               tile, the scene is never held in memory
+    tile_size: size of the tiles read in streaming mode
+    sample_size: number of pixels the model is fitted on, the other pixels
+                 are then assigned in parallel tiles. Every pixel is used
+                 when None
+    sampling: 'uniform' or 'stratified', see preprocessing.sample_pixels
+    deduplicate: if true identical raw pixels are clustered once, the model
+                 is fitted on the unique pixels weighted by their counts.
+                 Blurred pixels are nearly all unique so normalized
+                 features aren't blurred, the output and the model are
+                 named after it. Ignored in streaming mode
+    refit: if false the model saved by a previous fit with the same image
+           type, normalization, clusters and bands is reused, even if it was
+           fitted on another date. The image is then standardized and
+           blurred like the image the model was fitted on and the result
+           is logged as a prediction
     """
 
     log = Logger()
     image_path, date = project.get_image_paths(image_type,
                                                cropped, get_date=True)
-    data = RasterData(image_path)
+    data = RasterData(image_path, memmap=True, bands=bands)
+    deduplicate = deduplicate and not streaming
 
     output_path = ''
-    if normalized:
-        data.standard_normalize_array(inplace=True)
-        data.gaussian_blur_array(5)
-        output_path = '{}_normalized_blurred2_kmeans_{}.tiff'.format(clusters,
-                                                            image_type)
+    if normalized and deduplicate:
+        output_path = '{}_normalized_dedup_kmeans_{}.tiff'.format(
+            clusters, image_type)
+    elif normalized:
+        output_path = '{}_normalized_blurred2_kmeans_{}.tiff'.format(
+            clusters, image_type)
     else:
         output_path = '{}_kmeans_{}.tiff'.format(clusters, image_type)
 
-    kmeans_model = KMeans(n_clusters=clusters, n_init=80)
-    prediction = kmeans_model.fit_predict(data.flatten_array())
+    algorithm = 'minibatch_kmeans' if streaming else 'kmeans'
+    sigma = get_blur_sigma(algorithm, normalized, deduplicate)
+    model_path = get_model_path(project, image_type, normalized, algorithm,
+                                clusters, bands, deduplicate, sigma)
+    saved = None if refit else load_model(model_path)
+    statistics = None
+    if saved is not None:
+        statistics = saved['statistics']
+    elif normalized:
+        statistics = get_band_statistics(image_path, bands, tile_size)
+
+    if streaming:
+        output_data = create_output_raster(project, image_path, output_path,
+                                           cropped)
+        kmeans_model, inertia, counts = kmeans_streaming(
+            data, clusters, normalized, output_data, tile_size=tile_size,
+            model=saved and saved['model'], statistics=statistics,
+            sigma=sigma)
+        if saved is None:
+            save_model(model_path, kmeans_model, statistics, sigma,
+                       output_path, np.float32)
+        else:
+            algorithm, inertia = algorithm + ' predicted', None
+        results = sorted(counts[counts > 0].tolist())
+        log.log(project.project_name, date, image_type, clusters, cropped,
+                normalized, algorithm, inertia, str(results))
+        log.push_information()
+        return
+
+    if normalized and not deduplicate:
+        pipeline = data.pipeline().normalize(statistics)
+        if sigma > 0:
+            pipeline.blur(sigma)
+        data.array = pipeline.to_array(tile_size)
+
+    features = data.flatten_array()
+    counts = None
+    if deduplicate:
+        # The raw pixels are deduplicated, standardizing band by band maps
+        # identical pixels to identical features
+        features, counts, inverse = compress_pixels(features)
+        if normalized:
+            features = standardize(features, *statistics)
+
+    if saved is not None:
+        kmeans_model = saved['model']
+        features = features.astype(saved['dtype'], copy=False)
+        prediction = predict_in_tiles(kmeans_model.predict, features)
+        algorithm, inertia = algorithm + ' predicted', None
+    else:
+        kmeans_model = KMeans(n_clusters=clusters, n_init=80)
+        if sample_size is None:
+            prediction = kmeans_model.fit_predict(features,
+                                                  sample_weight=counts)
+        else:
+            sample = sample_pixels(data.array, sample_size, sampling)
+            if normalized and deduplicate:
+                sample = standardize(sample, *statistics)
+            kmeans_model.fit(sample)
+            prediction = predict_in_tiles(kmeans_model.predict, features)
+        inertia = kmeans_model.inertia_
+        save_model(model_path, kmeans_model, statistics, sigma, output_path,
+                   features.dtype)
+
+    if deduplicate:
+        prediction = prediction[inverse]
 
     results = list(np.unique(prediction, return_counts=True)[1])
     list.sort(results)
     log.log(project.project_name, date, image_type, clusters, cropped,
-            normalized, 'kmeans', kmeans_model.inertia_, str(results))
+            normalized, algorithm, inertia, str(results))
 
     log.push_information()
     save_output_result(prediction, project, image_path, output_path, cropped)
 
 
 def gmm_cluster(project, components, image_type='allbands',
-                cropped=True, normalized=True):
+                cropped=True, normalized=True, bands=None, sample_size=None,
+                sampling='uniform', deduplicate=False, refit=False):
     """
     Clusters raster data using Gaussian Mixture Models
+    bands: band numbers or descriptions used as features, all if None
+    sample_size: number of pixels the model is fitted and scored on, a
+                 saved model is only scored on them, the other pixels are
+                 then assigned in parallel tiles. Every pixel is used when
+                 None
+    sampling: 'uniform' or 'stratified', see preprocessing.sample_pixels
+    deduplicate: if true identical raw pixels are assigned once, without a
+                 sample size the model is fitted on WEIGHTED_SAMPLE_SIZE
+                 pixels drawn from the unique ones according to their counts
+    refit: if false the model saved by a previous fit with the same image
+           type, normalization, components and bands is reused, even if it
+           was fitted on another date. The image is then standardized like
+           the image the model was fitted on
     """
     image_path, date = project.get_image_paths(image_type,
                                                cropped, get_date=True)
-    data = RasterData(image_path)
+    data = RasterData(image_path, memmap=True, bands=bands)
     log = Logger()
 
-    jkkoutput_path = ''
+    model_path = get_model_path(project, image_type, normalized, 'gmm',
+                                components, bands, deduplicate)
+    saved = None if refit else load_model(model_path)
+    statistics = None
+    if saved is not None:
+        statistics = saved['statistics']
+    elif normalized:
+        statistics = get_band_statistics(image_path, bands)
+
+    output_path = ''
     if normalized:
-        data.standard_normalize_array(inplace=True)
+        if not deduplicate:
+            data.array = data.pipeline().normalize(statistics).to_array()
         output_path = '{}_normalized_gmm_{}.tiff'.format(components,
                                                          image_type)
     else:
         output_path = '{}_gmm_{}.tiff'.format(components, image_type)
 
-    gmm = GaussianMixture(n_components=components, n_init=10)
-    prediction = gmm.fit_predict(data.flatten_array())
+    features = data.flatten_array()
+    if deduplicate:
+        features, counts, inverse = compress_pixels(features)
+        if normalized:
+            features = standardize(features, *statistics)
+
+    if sample_size is not None:
+        fit_data = sample_pixels(data.array, sample_size, sampling)
+        if normalized and deduplicate:
+            fit_data = standardize(fit_data, *statistics)
+    elif deduplicate:
+        fit_data = resample_weighted(features, counts,
+                                     min(WEIGHTED_SAMPLE_SIZE,
+                                         int(counts.sum())))
+    else:
+        fit_data = features
+
+    if saved is not None:
+        gmm = saved['model']
+        features = features.astype(saved['dtype'], copy=False)
+        fit_data = fit_data.astype(saved['dtype'], copy=False)
+        prediction = predict_in_tiles(gmm.predict, features)
+    elif fit_data is features:
+        gmm = GaussianMixture(n_components=components, n_init=10)
+        prediction = gmm.fit_predict(fit_data)
+    else:
+        gmm = GaussianMixture(n_components=components, n_init=10)
+        gmm.fit(fit_data)
+        prediction = predict_in_tiles(gmm.predict, features)
+
+    if saved is None:
+        save_model(model_path, gmm, statistics, 0, output_path,
+                   features.dtype)
+
+    if deduplicate:
+        prediction = prediction[inverse]
     save_output_result(prediction, project, image_path, output_path, cropped)
 
     results = list(np.unique(prediction,return_counts=True)[1])
     list.sort(results)
 
     cost = {
-            "AIC": gmm.aic(data.flatten_array()),
-            "BIC": gmm.bic(data.flatten_array())
+            "AIC": gmm.aic(fit_data),
+            "BIC": gmm.bic(fit_data)
     }
     log.log(project.project_name, date, image_type, components, cropped,
-            normalized, 'gmm', cost, str(results))
+            normalized, 'gmm' if saved is None else 'gmm predicted', cost,
+            str(results))
+    log.push_information()
+
+
+def predict_cluster(project, date, algorithm, clusters,
+                    image_type='allbands', cropped=True, normalized=True,
+                    bands=None, tile_size=TILE_SIZE, deduplicate=False):
+    """
+    Applies a model saved by kmeans_cluster or gmm_cluster to the image of
+    another date, standardized with the statistics of the date the model was
+    fitted on so that labels are consistent between dates. Tiles are
+    predicted and written one at a time.
+    algorithm: 'kmeans', 'minibatch_kmeans' or 'gmm'
+    deduplicate: if true the model fitted with deduplicate is applied
+    """
+    model_path = get_model_path(
+        project, image_type, normalized, algorithm, clusters, bands,
+        deduplicate, get_blur_sigma(algorithm, normalized, deduplicate))
+    saved = load_model(model_path)
+    if saved is None:
+        raise FileNotFoundError('No {} model with {} clusters was fitted on '
+                                'the {} image'.format(algorithm, clusters,
+                                                      image_type))
+
+    image_path = project.find_image(date, image_type, cropped)
+    data = RasterData(image_path, bands=bands)
+    model = saved['model']
+
+    counts = np.zeros(clusters, dtype=np.int64)
+    output_data = create_output_raster(project, image_path, saved['output'],
+                                       cropped)
+    out_band = output_data.GetRasterBand(1)
+    for window, features in iterate_features(data, normalized,
+                                             saved['sigma'], tile_size,
+                                             saved['statistics']):
+        prediction = model.predict(features.astype(saved['dtype']))
+        counts += np.bincount(prediction, minlength=clusters)
+        out_band.WriteArray(
+            prediction.reshape(window.height, window.width).astype(
+                np.float32), window.x_off, window.y_off)
+    output_data.FlushCache()
+
+    log = Logger()
+    log.log(project.project_name, date, image_type, clusters, cropped,
+            normalized, algorithm + ' predicted', None,
+            str(sorted(counts[counts > 0].tolist())))
     log.push_information()
 
 
 def dbscan_cluster(project, min_samples=3, eps=100, image_type='rgb',
-                   cropped=True, normalized=True):
+                   cropped=True, normalized=True, sample_size=None,
+                   sampling='uniform'):
     """
     Clusters raster data using Dbscan model
+    sample_size: number of pixels DBSCAN is fitted on, the other pixels take
+                 the label of their nearest core sample, or are noise when
+                 it is further than eps. Every pixel is used when None
+    sampling: 'uniform' or 'stratified', see preprocessing.sample_pixels
     """
     image_path = project.get_image_paths(image_type, cropped)
-    data = RasterData(image_path)
+    data = RasterData(image_path, memmap=True)
 
     output_path = ''
     if normalized:
-        data.standard_normalize_array(inplace=True)
-        data.gaussian_blur_array(2)
+        data.array = data.pipeline().normalize().blur(2).to_array()
         output_path = '{}_normalized_dbscan_{}_{}.tiff'.format(eps, min_samples,
                                                                image_type)
     else:
         output_path = '{}_dbscan_{}_{}.tiff'.format(eps, min_samples,
                                                     image_type)
 
-    dbscan = DBSCAN(min_samples=min_samples, eps=100)
-    prediction = dbscan.fit_predict(data.flatten_array())
+    dbscan = DBSCAN(min_samples=min_samples, eps=eps)
+    if sample_size is None:
+        prediction = dbscan.fit_predict(data.flatten_array())
+    else:
+        dbscan.fit(sample_pixels(data.array, sample_size, sampling))
+        prediction = predict_in_tiles(get_core_sample_assigner(dbscan),
+                                      data.flatten_array())
     save_output_result(prediction, project, image_path, output_path, cropped)
@@ -5,8 +5,9 @@ DISPLAY SATELLITE IMAGERY AND CLUSTERING RESULTS
 import os
 import numpy as np
 import rasterio
+from rasterio.enums import Resampling
 from rasterio.plot import show
-from raster_data import RasterData
+from rasterio.transform import Affine
 import matplotlib.pyplot as plt
 
 THREEBANDS = ['rgb', 'agri', 'bathy', 'swi', 'geo']
@@ -17,6 +18,11 @@ BRIGHTNESS = {
     'geo': 2,
 }
 
+# Decimation factors of the overviews built in images, the coarsest ones
+# are skipped when they would be less than MIN_OVERVIEW_SIZE pixels wide
+OVERVIEW_FACTORS = [2, 4, 8, 16, 32, 64]
+MIN_OVERVIEW_SIZE = 256
+
 
 def show_image(project, image_type, cropped=True):
     """
@@ -27,8 +33,9 @@ def show_image(project, image_type, cropped=True):
         __show_three_bands(filepath, image_type)
         return
 
-    img = rasterio.open(filepath)
-    rasterio.plot.show(img, title=image_type, map='RdYlGn', vmin=-1, vmax=1)
+    data, transform = read_for_display(filepath)
+    rasterio.plot.show(data, transform=transform, title=image_type,
+                       cmap='RdYlGn', vmin=-1, vmax=1)
 
 
 def show_clustering(project, cropped=True):
@@ -37,8 +44,93 @@ def show_clustering(project, cropped=True):
     """
     filepath = project.get_clustering_path(cropped)
     title = filepath.split(os.sep)[-1].split('.')[0]
-    img = rasterio.open(filepath)
-    rasterio.plot.show(img, title=title, cmap="magma")
+    data, transform = read_for_display(filepath, resampling=Resampling.nearest)
+    rasterio.plot.show(data, transform=transform, title=title, cmap="magma")
+
+
+def get_overview_factors(width, height):
+    """
+    Returns the overview factors worth building for an image.
+    """
+    return [factor for factor in OVERVIEW_FACTORS
+            if min(width, height) // factor >= MIN_OVERVIEW_SIZE]
+
+
+def get_display_shape(width, height, figsize=None, dpi=None):
+    """
+    Returns the (height, width) an image is read at to be drawn on a figure,
+    the image shrunk to the pixels of the figure but never enlarged.
+    figsize: (width, height) of the figure in inches, matplotlib's default
+             if None
+    dpi: dots per inch of the figure, matplotlib's default if None
+    """
+    figsize = figsize or plt.rcParams['figure.figsize']
+    dpi = dpi or plt.rcParams['figure.dpi']
+    scale = min(1, figsize[0] * dpi / width, figsize[1] * dpi / height)
+    return (max(1, int(round(height * scale))),
+            max(1, int(round(width * scale))))
+
+
+def build_missing_overviews(filepath, resampling=Resampling.average):
+    """
+    Builds the internal overviews of a GeoTIFF without any. Other formats
+    are left as they are, jpeg2000 bands already hold reduced resolutions.
+    """
+    with rasterio.open(filepath) as dataset:
+        if dataset.driver != 'GTiff' or dataset.overviews(1):
+            return
+        factors = get_overview_factors(dataset.width, dataset.height)
+
+    if factors:
+        with rasterio.open(filepath, 'r+') as dataset:
+            dataset.build_overviews(factors, resampling)
+            dataset.update_tags(ns='rio_overview',
+                                resampling=resampling.name)
+
+
+def apply_scales(dataset, bands, data):
+    """
+    Returns the data read from bands of a rasterio dataset as the values
+    they represent, applying the scale and offset tags of the bands.
+    """
+    indexes = [bands] if isinstance(bands, int) else bands
+    scales = np.array([dataset.scales[band - 1] for band in indexes])
+    offsets = np.array([dataset.offsets[band - 1] for band in indexes])
+    if np.all(scales == 1) and np.all(offsets == 0):
+        return data
+
+    shape = (-1, 1, 1) if data.ndim == 3 else (1, 1)
+    return (data * scales.reshape(shape) +
+            offsets.reshape(shape)).astype(np.float32)
+
+
+def read_for_display(filepath, bands=None, figsize=None, dpi=None,
+                     resampling=Resampling.average):
+    """
+    Reads an image at the size it is drawn at, see get_display_shape. The
+    decimated read is served by the closest overview, built first if the
+    image has none. Returns the (bands, height, width) data, or
+    (height, width) when bands is an int, and its transform. The scale tags
+    of the bands, such as those of int16 indices, are applied.
+    bands: band number or list of band numbers read, every band if None
+    resampling: nearest should be used for labels such as clusterings
+    """
+    build_missing_overviews(filepath, resampling)
+    with rasterio.open(filepath) as dataset:
+        height, width = get_display_shape(dataset.width, dataset.height,
+                                          figsize, dpi)
+        if bands is None:
+            bands = list(dataset.indexes)
+        out_shape = (height, width)
+        if not isinstance(bands, int):
+            out_shape = (len(bands), height, width)
+        data = dataset.read(bands, out_shape=out_shape,
+                            resampling=resampling)
+        data = apply_scales(dataset, bands, data)
+        transform = dataset.transform * Affine.scale(
+            dataset.width / width, dataset.height / height)
+
+    return data, transform
 
 
 image_type = 'ndvi'
@@ -59,8 +151,8 @@ def show_grid_results(project):
     """
     date = project.get_possible_dates()
     image_path = project.find_image(date, 'rgb')
-    original_image = RasterData(image_path)
-    normed = __normalize_array(original_image.array, 'rgb')
+    original_image, _ = read_for_display(image_path, [1, 2, 3])
+    normed = __normalize_array(np.moveaxis(original_image, 0, -1), 'rgb')
 
     plt.close('all')
     ax1 = plt.subplot(121)
@@ -106,16 +198,15 @@ def get_result_plot(project, date, algorithm, training_set, cropped,
     """
     path = project.find_clustering_path(date, algorithm, training_set,
                                         n_clusters, cropped)
-    image = RasterData(path)
-    return image.array
+    data, _ = read_for_display(path, 1, resampling=Resampling.nearest)
+    return data
 
 
 def __show_three_bands(file_path, image_type):
     """
     Used within the file to help with plotting real color imagery
     """
-    src = rasterio.open(file_path)
-    data = src.read()
+    data, _ = read_for_display(file_path, [1, 2, 3])
     stack1 = __normalize_array(data[0], image_type)
     stack2 = __normalize_array(data[1], image_type)
     stack3 = __normalize_array(data[2], image_type)
@@ -0,0 +1,352 @@
+"""
+Exports products to 8 bit PNG or WebP images and to z/x/y web mercator tile
+pyramids. Tiles of the product are rendered straight from their data with
+a percentile stretch or a colormap lookup table, concurrently.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil, floor, log2
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import Affine, from_origin
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import transform as window_transform
+import matplotlib.pyplot as plt
+from PIL import Image
+from display import THREEBANDS, apply_scales
+from preprocessing import TILE_SIZE
+
+# Folder of the images folder the exports of every date are written to
+MOSAICS_FOLDER = 'mosaics'
+
+# Percentiles of each band mapped to black and white by the stretch
+PERCENTILES = (2, 98)
+
+# Longest side of the decimated read the stretch percentiles come from
+STATISTICS_SIZE = 1024
+
+# Side of the web mercator tiles and half the width of the mercator world
+TILE_PIXELS = 256
+MERCATOR_EXTENT = 20037508.342789244
+MERCATOR_CRS = 'EPSG:3857'
+
+# Number of zoom levels below the native one of a product in its pyramid
+PYRAMID_LEVELS = 5
+
+# Colormap and range of the single band products (indices)
+INDEX_COLORMAP = 'RdYlGn'
+INDEX_RANGE = (-1, 1)
+
+
+class DatasetPool():
+    """
+    Opens a product once per thread, rasterio datasets can't be shared
+    between threads.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.local = threading.local()
+        self.datasets = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for dataset in self.datasets:
+            dataset.close()
+
+    def get(self):
+        """
+        Returns the dataset of the calling thread.
+        """
+        if not hasattr(self.local, 'dataset'):
+            self.local.dataset = rasterio.open(self.filepath)
+            with self.lock:
+                self.datasets.append(self.local.dataset)
+        return self.local.dataset
+
+
+def get_colormap_lut(cmap):
+    """
+    Returns the (256, 3) uint8 lookup table of a matplotlib colormap.
+    """
+    colors = plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:, :3]
+    return np.round(colors * 255).astype(np.uint8)
+
+
+def get_limits(dataset, bands, percentiles=PERCENTILES, vmin=None,
+               vmax=None):
+    """
+    Returns the (bands, 2) values mapped to 0 and 255 for each band. They
+    are vmin and vmax when given, otherwise the percentiles of the band
+    read decimated to at most STATISTICS_SIZE pixels.
+    """
+    if vmin is not None and vmax is not None:
+        return np.array([[vmin, vmax]] * len(bands), dtype=np.float64)
+
+    scale = min(1, STATISTICS_SIZE / max(dataset.width, dataset.height))
+    out_shape = (len(bands), max(1, int(round(dataset.height * scale))),
+                 max(1, int(round(dataset.width * scale))))
+    sample = read_masked(dataset, bands, out_shape=out_shape,
+                         resampling=Resampling.nearest)
+
+    limits = []
+    for band in sample:
+        values = band[np.isfinite(band)]
+        limits.append(np.percentile(values, percentiles) if values.size
+                      else (0, 1))
+    limits = np.array(limits, dtype=np.float64)
+    if vmin is not None:
+        limits[:, 0] = vmin
+    if vmax is not None:
+        limits[:, 1] = vmax
+    return limits
+
+
+def read_masked(dataset, bands, window=None, out_shape=None,
+                resampling=Resampling.nearest):
+    """
+    Reads bands as a float32 (bands, height, width) array where nodata
+    pixels are nan, the scale tags of the bands being applied.
+    """
+    data = dataset.read(bands, window=window, out_shape=out_shape,
+                        resampling=resampling, masked=True)
+    data = data.astype(np.float32).filled(np.nan)
+    return apply_scales(dataset, bands, data)
+
+
+def render(data, limits, lut=None):
+    """
+    Returns the (height, width, 4) uint8 RGBA rendering of a float
+    (bands, height, width) array, nan pixels being transparent. Each band
+    is stretched between its limits, a single band is then colored through
+    the lookup table.
+    """
+    low = limits[:, 0, np.newaxis, np.newaxis]
+    high = limits[:, 1, np.newaxis, np.newaxis]
+    valid = np.all(np.isfinite(data), axis=0)
+    scaled = np.clip((data - low) / np.maximum(high - low, 1e-12), 0, 1)
+    scaled = np.round(np.nan_to_num(scaled) * 255).astype(np.uint8)
+
+    rgba = np.empty(data.shape[1:] + (4,), dtype=np.uint8)
+    if lut is not None:
+        rgba[:, :, :3] = lut[scaled[0]]
+    else:
+        rgba[:, :, :3] = np.moveaxis(scaled[:3], 0, -1)
+    rgba[:, :, 3] = valid * 255
+    return rgba
+
+
+def get_render_options(image_type):
+    """
+    Returns the (bands, cmap, vmin, vmax) a product type is rendered with,
+    three band products are stretched and the others use the index
+    colormap.
+    """
+    if image_type.lower() in THREEBANDS:
+        return [1, 2, 3], None, None, None
+    return [1], INDEX_COLORMAP, INDEX_RANGE[0], INDEX_RANGE[1]
+
+
+def export_image(filepath, output_path, bands=None, cmap=None, vmin=None,
+                 vmax=None, percentiles=PERCENTILES, tile_size=TILE_SIZE,
+                 workers=None):
+    """
+    Writes a product at full resolution to a PNG or WebP image, the format
+    being taken from the extension of output_path. Tiles are read and
+    rendered concurrently.
+    bands: band numbers rendered as RGB, or a single band colored with cmap.
+           The first three bands, or the first one with a cmap, if None
+    cmap: matplotlib colormap of a single band product
+    vmin, vmax: values mapped to the ends of the stretch or colormap, the
+                percentiles of each band are used for those not given
+    workers: number of threads, chosen by the executor if None
+    """
+    with rasterio.open(filepath) as dataset:
+        if bands is None:
+            bands = [1] if cmap or dataset.count < 3 else [1, 2, 3]
+        limits = get_limits(dataset, bands, percentiles, vmin, vmax)
+        width, height = dataset.width, dataset.height
+
+    lut = None
+    if cmap is not None or len(bands) == 1:
+        lut = get_colormap_lut(cmap or 'gray')
+
+    image = np.empty((height, width, 4), dtype=np.uint8)
+    windows = [Window(col, row, min(tile_size, width - col),
+                      min(tile_size, height - row))
+               for row in range(0, height, tile_size)
+               for col in range(0, width, tile_size)]
+
+    with DatasetPool(filepath) as pool:
+        def export_window(window):
+            data = read_masked(pool.get(), bands, window)
+            image[window.row_off:window.row_off + window.height,
+                  window.col_off:window.col_off + window.width] = render(
+                      data, limits, lut)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(export_window, windows))
+
+    Image.fromarray(image, 'RGBA').save(output_path)
+    return output_path
+
+
+def get_native_zoom(dataset):
+    """
+    Returns the web mercator zoom level whose pixels are closest to the
+    product's pixels.
+    """
+    left, bottom, right, _ = transform_bounds(dataset.crs, MERCATOR_CRS,
+                                              *dataset.bounds)
+    resolution = (right - left) / dataset.width
+    return max(0, int(round(log2(2 * MERCATOR_EXTENT /
+                                 (TILE_PIXELS * resolution)))))
+
+
+def get_tile_indices(dataset, zoom):
+    """
+    Returns the (x, y) indices of the tiles of a zoom level covering the
+    product.
+    """
+    left, bottom, right, top = transform_bounds(dataset.crs, MERCATOR_CRS,
+                                                *dataset.bounds)
+    size = 2 * MERCATOR_EXTENT / 2 ** zoom
+    last = 2 ** zoom - 1
+
+    def index(value):
+        return min(last, max(0, int(floor(value / size))))
+
+    return [(x, y)
+            for x in range(index(left + MERCATOR_EXTENT),
+                           index(right + MERCATOR_EXTENT) + 1)
+            for y in range(index(MERCATOR_EXTENT - top),
+                           index(MERCATOR_EXTENT - bottom) + 1)]
+
+
+def read_tile(dataset, bands, zoom, x, y, resampling=Resampling.bilinear):
+    """
+    Returns the float32 (bands, TILE_PIXELS, TILE_PIXELS) web mercator tile
+    of the product, nan outside of it, or None if they don't overlap. The
+    product is read decimated to about twice the tile resolution, from its
+    overviews when it has some, before being reprojected.
+    """
+    size = 2 * MERCATOR_EXTENT / 2 ** zoom
+    left = -MERCATOR_EXTENT + x * size
+    top = MERCATOR_EXTENT - y * size
+    bounds = transform_bounds(MERCATOR_CRS, dataset.crs, left, top - size,
+                              left + size, top)
+    window = from_bounds(*bounds, transform=dataset.transform)
+    col_off = max(0, int(floor(window.col_off)))
+    row_off = max(0, int(floor(window.row_off)))
+    col_end = min(dataset.width, int(ceil(window.col_off + window.width)))
+    row_end = min(dataset.height, int(ceil(window.row_off + window.height)))
+    if col_end <= col_off or row_end <= row_off:
+        return None
+
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    scale = max(1, min(window.width, window.height) / (2 * TILE_PIXELS))
+    out_height = max(1, int(ceil(window.height / scale)))
+    out_width = max(1, int(ceil(window.width / scale)))
+    data = read_masked(dataset, bands, window,
+                       (len(bands), out_height, out_width), resampling)
+    source_transform = (window_transform(window, dataset.transform) *
+                        Affine.scale(window.width / out_width,
+                                     window.height / out_height))
+
+    tile = np.full((len(bands), TILE_PIXELS, TILE_PIXELS), np.nan,
+                   dtype=np.float32)
+    reproject(data, tile, src_transform=source_transform,
+              src_crs=dataset.crs, src_nodata=np.nan,
+              dst_transform=from_origin(left, top, size / TILE_PIXELS,
+                                        size / TILE_PIXELS),
+              dst_crs=MERCATOR_CRS, dst_nodata=np.nan,
+              resampling=resampling)
+    return tile
+
+
+def export_tiles(filepath, output_folder, zooms=None, bands=None, cmap=None,
+                 vmin=None, vmax=None, percentiles=PERCENTILES,
+                 resampling=Resampling.bilinear, workers=None):
+    """
+    Writes the z/x/y web mercator PNG tile pyramid of a product to
+    output_folder and returns the number of tiles written. The stretch is
+    computed once for the whole product so that tiles match.
+    zooms: zoom levels written, the native one and the PYRAMID_LEVELS below
+           it if None
+    resampling: nearest should be used for labels such as clusterings
+    See export_image for the other parameters.
+    """
+    with rasterio.open(filepath) as dataset:
+        if bands is None:
+            bands = [1] if cmap or dataset.count < 3 else [1, 2, 3]
+        limits = get_limits(dataset, bands, percentiles, vmin, vmax)
+        if zooms is None:
+            native = get_native_zoom(dataset)
+            zooms = range(max(0, native - PYRAMID_LEVELS), native + 1)
+        tiles = [(zoom, x, y) for zoom in zooms
+                 for x, y in get_tile_indices(dataset, zoom)]
+
+    lut = None
+    if cmap is not None or len(bands) == 1:
+        lut = get_colormap_lut(cmap or 'gray')
+
+    with DatasetPool(filepath) as pool:
+        def export_tile(tile):
+            zoom, x, y = tile
+            data = read_tile(pool.get(), bands, zoom, x, y, resampling)
+            if data is None or not np.isfinite(data).any():
+                return 0
+            tile_folder = os.path.join(output_folder, str(zoom), str(x))
+            os.makedirs(tile_folder, exist_ok=True)
+            Image.fromarray(render(data, limits, lut), 'RGBA').save(
+                os.path.join(tile_folder, '{}.png'.format(y)))
+            return 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(export_tile, tiles))
+
+
+def export_mosaics(project, image_types, cropped=True, image_format='png',
+                   tiles=False, zooms=None, workers=None):
+    """
+    Exports the products of every date of the project to
+    images/mosaics/<date>/, as <project>_<TYPE>.<image_format> images and,
+    if tiles is true, as <TYPE>/z/x/y.png pyramids. Exports newer than
+    their product are kept as they are.
+    image_format: 'png' or 'webp'
+    """
+    images_folder = project.get_images_folder_path()
+    dates = sorted(date for date in os.listdir(images_folder)
+                   if date != MOSAICS_FOLDER and not date.startswith('.'))
+    for date in dates:
+        output_folder = os.path.join(images_folder, MOSAICS_FOLDER, date)
+        for image_type in image_types:
+            filepath = project.find_image(date, image_type, cropped)
+            if filepath is None:
+                continue
+
+            os.makedirs(output_folder, exist_ok=True)
+            bands, cmap, vmin, vmax = get_render_options(image_type)
+            output_path = os.path.join(output_folder, '{}_{}.{}'.format(
+                project.project_name, image_type.upper(), image_format))
+            if not is_up_to_date(filepath, output_path):
+                export_image(filepath, output_path, bands, cmap, vmin, vmax,
+                             workers=workers)
+
+            tiles_folder = os.path.join(output_folder, image_type.upper())
+            if tiles and not is_up_to_date(filepath, tiles_folder):
+                export_tiles(filepath, tiles_folder, zooms, bands, cmap,
+                             vmin, vmax, workers=workers)
+
+
+def is_up_to_date(filepath, output_path):
+    """
+    Returns true if output_path exists and is newer than filepath.
+    """
+    return (os.path.exists(output_path) and
+            os.path.getmtime(output_path) >= os.path.getmtime(filepath))
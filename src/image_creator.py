@@ -5,104 +5,420 @@ https://gisgeography.com/sentinel-2-bands-combinations/
 https://www.satimagingcorp.com/satellite-sensors/other-satellite-sensors/sentinel-2a/
 """
 
+from math import ceil, floor
 from os import listdir, path
-import matplotlib.pyplot as plt
 import numpy as np
 import rasterio
 import rasterio.mask
-from display import __normalize_array, THREEBANDS
-
-
-def create_batch_images(index, project):
+from rasterio.enums import Resampling
+from rasterio.windows import Window, from_bounds, bounds as window_bounds
+from display import get_overview_factors
+from exporter import export_image, get_render_options
+from preprocessing import TILE_SIZE
+from band_cache import BandCache, scene_cache, CACHE_BYTES
+from manifest import Manifest
+
+# Products built by the index engine, each one is described by the
+# resolution folder of its grid (0: R10m, 1: R20m, 2: R60m), the
+# (resolution folder, band) pairs it needs and whether it is a normalized
+# difference of its two bands or a stack of them. Bands of another
+# resolution than the grid are resampled onto it while reading.
+PRODUCTS = {
+    'RGB': (0, [(0, 'B04'), (0, 'B03'), (0, 'B02')], False),
+    'NDVI': (0, [(0, 'B08'), (0, 'B04')], True),
+    'NDWI': (1, [(1, 'B03'), (1, 'B8A')], True),
+    'NDBI': (1, [(1, 'B11'), (1, 'B8A')], True),
+    'SWI': (0, [(0, 'B04'), (1, 'B8A'), (1, 'B12')], False),
+    'GEO': (0, [(0, 'B02'), (1, 'B11'), (1, 'B12')], False),
+    'BAT': (0, [(0, 'B04'), (0, 'B03'), (2, 'B01')], False),
+    'AGRI': (0, [(0, 'B02'), (1, 'B11'), (0, 'B08')], False),
+}
+
+BATCH_PRODUCTS = ['RGB', 'NDVI', 'NDWI', 'NDBI']
+
+# Resampling methods available to align bands onto a product grid
+RESAMPLING = {
+    'nearest': Resampling.nearest,
+    'bilinear': Resampling.bilinear,
+    'average': Resampling.average,
+}
+
+# Creation options of every written product: tiled, compressed GeoTIFFs
+# with internal overviews so that windowed and overview reads stay cheap.
+# 'zstd' can be used as compression with gdal 2.3 and above.
+OUTPUT_PROFILE = {
+    'driver': 'GTiff',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512,
+    'compress': 'deflate',
+}
+
+# Types the indices can be written in, 'int16' holds the index multiplied
+# by INDEX_SCALE and the file scale tag undoes it, readers apply it.
+INDEX_DTYPES = ('float32', 'int16')
+INDEX_SCALE = 10000
+
+
+def create_batch_images(index, project, cache_bytes=None, aoi=False,
+                        index_dtype='float32'):
     """
     Loops through all available information to create imagery
+    cache_bytes: memory budget of the band cache shared by the products
+    aoi: if true only the area of interest of the project kml is read and
+         the cropped products are written directly
+    index_dtype: type of the index products, see create_products
     """
     output = index[1]
-    create_rgb(index, project, output)
-    create_ndvi(index, project, output)
-    create_ndwi(index, project, output)
-    create_ndbi(index, project, output)
-    # crop_images(index, project, output)
+    manifest = Manifest(output)
+    with BandCache(cache_bytes or CACHE_BYTES) as cache:
+        create_products(index, project, output, BATCH_PRODUCTS, cache,
+                        manifest, aoi, index_dtype=index_dtype)
+        # crop_images(index, project, output, cache, manifest)
+    manifest.save()
 
 
-def create_images(project):
-    """creates all desired images"""
+def create_images(project, cache_bytes=None, aoi=False,
+                  index_dtype='float32'):
+    """
+    creates all desired images
+    aoi: if true only the area of interest of the project kml is read and
+         the cropped products are written directly
+    index_dtype: type of the index products, see create_products
+    """
     info = project.get_resolution_paths()
-    if info is False:
+    output = info[1]
+    manifest = Manifest(output)
+    with BandCache(cache_bytes or CACHE_BYTES) as cache:
+        built = create_products(info, project, output, BATCH_PRODUCTS,
+                                cache, manifest, aoi,
+                                index_dtype=index_dtype)
+
+        cropped = []
+        if not aoi:
+            cropped = crop_images(info, project, output, cache, manifest)
+    manifest.save()
+
+    if not built and not cropped:
         print('images were already created')
-        return
 
-    output = info[1]
-    create_rgb(info, project, output)
-    create_ndvi(info, project, output)
-    create_ndbi(info, project, output)
-    create_ndwi(info, project, output)
 
-    crop_images(info, project, output)
+def get_windows(reader, tile_size=TILE_SIZE, area=None):
+    """
+    Yields windows covering the raster, aligned to its block size and
+    spanning a multiple of it at least tile_size pixels wide.
+    area: window of the raster to cover instead of the whole raster, the
+          windows are clipped to it
+    """
+    if area is None:
+        area = Window(0, 0, reader.width, reader.height)
+    block_y, block_x = reader.block_shapes[0]
+    step_x = block_x * max(1, tile_size // block_x)
+    step_y = block_y * max(1, tile_size // block_y)
+    row_end = area.row_off + area.height
+    col_end = area.col_off + area.width
+    for row in range(area.row_off - area.row_off % step_y, row_end, step_y):
+        for col in range(area.col_off - area.col_off % step_x, col_end,
+                         step_x):
+            top = max(row, area.row_off)
+            left = max(col, area.col_off)
+            yield Window(left, top, min(col + step_x, col_end) - left,
+                         min(row + step_y, row_end) - top)
+
+
+def get_aoi_window(project, reader):
+    """
+    Returns the window of the raster covering the bounding box of the
+    project kml, grown to whole pixels and clipped to the raster.
+    """
+    bounds = project.get_bounding_box(reader.crs).total_bounds
+    window = from_bounds(*bounds, transform=reader.transform)
+    col_off = max(0, int(floor(window.col_off)))
+    row_off = max(0, int(floor(window.row_off)))
+    col_end = min(reader.width, int(ceil(window.col_off + window.width)))
+    row_end = min(reader.height, int(ceil(window.row_off + window.height)))
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def get_output_profile(dtype, meta):
+    """
+    Returns the creation options of a product of the given type, meta
+    holds its size and georeferencing.
+    """
+    profile = dict(meta)
+    profile.update(OUTPUT_PROFILE)
+    profile['dtype'] = dtype
+    # floating point predictor for floats, horizontal differencing otherwise
+    profile['predictor'] = 3 if np.dtype(dtype).kind == 'f' else 2
+    return profile
+
+
+def close_output(dataset, scale=None):
+    """
+    Builds the internal overviews of a written product and closes it.
+    scale: value the stored data was multiplied by, saved in the file
+    """
+    if scale is not None:
+        dataset.scales = [1 / scale] * dataset.count
+    factors = get_overview_factors(dataset.width, dataset.height)
+    if factors:
+        dataset.build_overviews(factors, Resampling.average)
+        dataset.update_tags(ns='rio_overview', resampling='average')
+    dataset.close()
+
+
+def to_index_dtype(index, index_dtype='float32'):
+    """
+    Converts a float32 index to index_dtype, one of INDEX_DTYPES
+    """
+    if index_dtype == 'int16':
+        return np.round(index * INDEX_SCALE).astype(np.int16)
+    return index
+
+
+def normalized_difference(first, second):
+    """
+    Returns (first - second) / (first + second) in float32, pixels where
+    both bands sum to zero are set to zero without being divided.
+    """
+    first = first.astype(np.float32)
+    second = second.astype(np.float32)
+    total = first + second
+    return np.divide(first - second, total, out=np.zeros_like(total),
+                     where=total != 0)
+
+
+def get_product_path(project, output, product, aoi=False):
+    """
+    Returns the path of a product of PRODUCTS in the output folder, or of
+    its cropped version when aoi is true
+    """
+    if aoi:
+        return path.join(output, 'cropped', '{}_{}_Cropped.tiff'.format(
+            project.project_name, product))
+    return path.join(output, '{}_{}.tiff'.format(project.project_name,
+                                                 product))
+
+
+def get_product_inputs(info, product):
+    """
+    Returns the paths of the bands a product of PRODUCTS is built from
+    """
+    return [info[0][resolution][band]
+            for resolution, band in PRODUCTS[product][1]]
+
+
+def get_product_parameters(product, resampling='bilinear',
+                           index_dtype='float32'):
+    """
+    Returns the parameters a product of PRODUCTS is built with, as recorded
+    in the manifest
+    """
+    resolution, bands, is_index = PRODUCTS[product]
+    parameters = {'resolution': resolution,
+                  'bands': [list(band) for band in bands],
+                  'index': is_index,
+                  'dtype': index_dtype if is_index else 'source',
+                  'profile': OUTPUT_PROFILE}
+    if any(band[0] != resolution for band in bands):
+        parameters['resampling'] = resampling
+    return parameters
+
+
+def get_product_entry(info, project, output, product, aoi=False,
+                      resampling='bilinear', index_dtype='float32'):
+    """
+    Returns the manifest key, inputs, parameters and outputs of a product
+    of PRODUCTS
+    """
+    filepath = get_product_path(project, output, product, aoi)
+    inputs = get_product_inputs(info, product)
+    parameters = get_product_parameters(product, resampling, index_dtype)
+    if not aoi:
+        return product, inputs, parameters, [filepath]
+
+    inputs.append(project.get_kml_path())
+    parameters['aoi'] = True
+    return path.basename(filepath), inputs, parameters, [filepath]
 
 
-def crop_images(info, project, output):
+def create_products(info, project, output, products, cache=None,
+                    manifest=None, aoi=False, resampling='bilinear',
+                    index_dtype='float32'):
+    """
+    Index engine creating several products of PRODUCTS in a single pass.
+    Products sharing a resolution are built together, window by window:
+    every band they need is decoded once per window and all their outputs
+    are written before moving on to the next window.
+    cache: BandCache of the scene, a temporary one is used if None
+    manifest: Manifest of the date, products it lists as up to date are
+              skipped and the rebuilt ones are recorded in it
+    aoi: if true only the window covering the bounding box of the project
+         kml is decoded and the cropped products are written directly
+    resampling: 'nearest', 'bilinear' or 'average', method aligning bands
+                of another resolution onto the grid of a product
+    index_dtype: one of INDEX_DTYPES, 'int16' halves the size of the index
+                 products, their scale tag is applied when they are read
+    Returns the list of products that were built.
+    """
+    if index_dtype not in INDEX_DTYPES:
+        raise ValueError('unknown index type {}'.format(index_dtype))
+
+    if manifest is not None:
+        products = [product for product in products
+                    if not manifest.is_up_to_date(*get_product_entry(
+                        info, project, output, product, aoi, resampling,
+                        index_dtype))]
+
+    with scene_cache(cache) as cache:
+        __create_products(info, project, output, products, cache, aoi,
+                          resampling, index_dtype)
+
+    if manifest is not None:
+        for product in products:
+            manifest.record(*get_product_entry(info, project, output,
+                                               product, aoi, resampling,
+                                               index_dtype))
+
+    return products
+
+
+def read_aligned(cache, filepath, reference, window, resampling='bilinear'):
+    """
+    Reads a band over a window of the reference grid. Bands of another
+    resolution are resampled onto the window while being decoded, so no
+    full resampled copy of the band is ever made.
+    """
+    source = cache.get_reader(filepath)
+    if (source.transform == reference.transform and
+            source.shape == reference.shape):
+        return cache.read(filepath, window=window)
+
+    source_window = from_bounds(
+        *window_bounds(window, reference.transform),
+        transform=source.transform)
+    return cache.read(filepath, window=source_window,
+                      out_shape=(window.height, window.width),
+                      resampling=RESAMPLING[resampling])
+
+
+def __create_products(info, project, output, products, cache, aoi,
+                      resampling, index_dtype):
+    """
+    Builds the products of create_products with the bands of the cache
+    """
+    resolutions = sorted({PRODUCTS[product][0] for product in products})
+    for resolution in resolutions:
+        selected = [product for product in products
+                    if PRODUCTS[product][0] == resolution]
+        band_keys = sorted({band for product in selected
+                            for band in PRODUCTS[product][1]})
+        paths = {key: info[0][key[0]][key[1]] for key in band_keys}
+        reference = cache.get_reader(paths[next(
+            key for key in band_keys if key[0] == resolution)])
+        area = Window(0, 0, reference.width, reference.height)
+        if aoi:
+            area = get_aoi_window(project, reference)
+
+        writers = {}
+        for product in selected:
+            _, bands, is_index = PRODUCTS[product]
+            filepath = get_product_path(project, output, product, aoi)
+            meta = reference.meta.copy()
+            meta.update(count=1 if is_index else len(bands),
+                        width=area.width, height=area.height,
+                        transform=reference.window_transform(area))
+            writers[product] = rasterio.open(
+                filepath, 'w', **get_output_profile(
+                    index_dtype if is_index else reference.dtypes[0], meta))
+
+        for window in get_windows(reference, area=area):
+            data = {key: read_aligned(cache, paths[key], reference, window,
+                                      resampling)
+                    for key in band_keys}
+            out_window = Window(window.col_off - area.col_off,
+                                window.row_off - area.row_off,
+                                window.width, window.height)
+            for product in selected:
+                _, bands, is_index = PRODUCTS[product]
+                if is_index:
+                    writers[product].write(
+                        to_index_dtype(normalized_difference(
+                            data[bands[0]], data[bands[1]]), index_dtype),
+                        1, window=out_window)
+                else:
+                    writers[product].write(
+                        np.stack([data[band] for band in bands]),
+                        window=out_window)
+
+        for product, writer in writers.items():
+            is_index = PRODUCTS[product][2]
+            close_output(writer, INDEX_SCALE if is_index and
+                         index_dtype == 'int16' else None)
+
+
+def crop_images(info, project, output, cache=None, manifest=None):
     """
     crops the images to the bounding box of the geometry found within
     the kml file
+    manifest: Manifest of the date, cropped images it lists as up to date
+              are skipped and the rebuilt ones are recorded in it
+    Returns the list of cropped images that were written.
     """
-    b02 = rasterio.open(info[0][0]['B02'])
-    projection = project.get_bounding_box(b02.crs)
+    with scene_cache(cache) as cache:
+        b02 = cache.get_reader(info[0][0]['B02'])
+        projection = project.get_bounding_box(b02.crs)
     non_cropped_path = output
     output_path = path.join(output, 'cropped')
+    parameters = {'crop': 'bounding_box', 'crs': str(b02.crs)}
 
+    cropped = []
     files = listdir(non_cropped_path)
     for data in files:
         if (path.isdir(path.join(non_cropped_path, data)) or
-                '_Cropped' in data or '.aux' in data):
+                '_Cropped' in data or not data.endswith('.tiff')):
             continue
         filepath = path.join(non_cropped_path, data)
+        write_path = path.join(output_path, data.replace('.tiff',
+                                                         '_Cropped.tiff'))
+        inputs = [filepath, project.get_kml_path()]
+        product = path.basename(write_path)
+        if manifest is not None and manifest.is_up_to_date(
+                product, inputs, parameters, [write_path]):
+            continue
+
         with rasterio.open(filepath) as src:
             out_image, out_transform = rasterio.mask.mask(
                 src, projection.geometry, crop=True)
-            out_meta = src.meta.copy()
-            out_meta.update({"driver": "GTiff",
-                             "height": out_image.shape[1],
+            out_meta = get_output_profile(src.dtypes[0], src.meta)
+            out_meta.update({"height": out_image.shape[1],
                              "width": out_image.shape[2],
                              "transform": out_transform})
+            scales = src.scales
 
-        write_path = path.join(output_path, data.replace('.tiff',
-                                                         '_Cropped.tiff'))
-        with rasterio.open(write_path, "w", **out_meta) as dest:
-            dest.write(out_image)
+        dest = rasterio.open(write_path, "w", **out_meta)
+        dest.write(out_image)
+        dest.scales = scales
+        close_output(dest)
+
+        if manifest is not None:
+            manifest.record(product, inputs, parameters, [write_path])
+        cropped.append(write_path)
 
+    return cropped
 
-def create_ndbi(info, project, output):
+
+def create_ndbi(info, project, output, cache=None):
     """
     The moisture index is ideal for finding water stress in plants. It uses
     the short-wave and near-infrared to generate an index of moisture content.
     In general, wetter vegetation has higher values. But lower moisture index
     values suggest plants are under stress from insufficient moisture
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'NDBI.tiff'))
-
-    # print(info[0][1])
-    r20 = info[0][1]
-
-    nir_reader = rasterio.open(r20['B8A'], driver='JP2OpenJPEG')
-    swir_reader = rasterio.open(r20['B11'], driver='JP2OpenJPEG')
+    create_products(info, project, output, ['NDBI'], cache)
 
-    nir = nir_reader.read(1).astype('float64')
-    swir = swir_reader.read(1).astype('float64')
 
-    ndbi = np.where((swir+nir) == 0, 0, (swir-nir)/(swir+nir))
-    ndbi_image = rasterio.open(filepath, 'w', driver='Gtiff',
-                               width=nir_reader.width,
-                               height=nir_reader.height,
-                               count=1, crs=nir_reader.crs,
-                               transform=nir_reader.transform,
-                               dtype='float64')
-    ndbi_image.write(ndbi, 1)
-    ndbi_image.close()
-
-
-def create_ndwi(info, project, output):
+def create_ndwi(info, project, output, cache=None):
     """
     The NDWI is used to monitor changes related to water content in water
     bodies. As water bodies strongly absorb light in visible to infrared
@@ -111,30 +427,10 @@ def create_ndwi(info, project, output):
     in over-estimation of water bodies. The index was proposed by McFeeters,
     1996.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'NDWI.tiff'))
-
-    # print(info[0][1])
-    r20 = info[0][1]
-
-    green_reader = rasterio.open(r20['B03'], driver='JP2OpenJPEG')
-    vnir_reader = rasterio.open(r20['B8A'], driver='JP2OpenJPEG')
-
-    green = green_reader.read(1).astype('float64')
-    vnir = vnir_reader.read(1).astype('float64')
-
-    ndbi = np.where((green+vnir) == 0, 0, (green-vnir)/(green+vnir))
-    ndbi_image = rasterio.open(filepath, 'w', driver='Gtiff',
-                               width=vnir_reader.width,
-                               height=vnir_reader.height,
-                               count=1, crs=vnir_reader.crs,
-                               transform=vnir_reader.transform,
-                               dtype='float64')
-    ndbi_image.write(ndbi, 1)
-    ndbi_image.close()
+    create_products(info, project, output, ['NDWI'], cache)
 
 
-def create_ndvi(info, project, output):
+def create_ndvi(info, project, output, cache=None):
     """
     Because near-infrared (which vegetation strongly reflects) and red light
     (which vegetation absorbs), the vegetation index is good for quantifying
@@ -142,125 +438,47 @@ def create_ndvi(info, project, output):
     vegetation index is (B8-B4)/(B8+B4). While high values suggest dense
     canopy, low or negative values indicate urban and water features.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'NDVI.tiff'))
+    create_products(info, project, output, ['NDVI'], cache)
 
-    r10 = info[0][0]
-    nir_reader = rasterio.open(r10['B08'], driver='JP2OpenJPEG')
-    red_reader = rasterio.open(r10['B04'], driver='JP2OpenJPEG')
 
-    nir = nir_reader.read(1).astype('float64')
-    red = red_reader.read(1).astype('float64')
-
-    ndvi = np.where((nir+red) == 0, 0, (nir-red)/(nir+red))
-    ndvi_image = rasterio.open(filepath, 'w', driver='Gtiff',
-                               width=nir_reader.width,
-                               height=nir_reader.height,
-                               count=1, crs=nir_reader.crs,
-                               transform=nir_reader.transform,
-                               dtype='float64')
-    ndvi_image.write(ndvi, 1)
-    ndvi_image.close()
-
-
-def create_swi(info, project, output):
+def create_swi(info, project, output, cache=None, resampling='bilinear'):
     """
     This composite shows vegetation in various shades of green. In general,
     darker shades of green indicate denser vegetation. But brown is indicative
     of bare soil and built-up areas.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'SWI.tiff'))
+    create_products(info, project, output, ['SWI'], cache,
+                    resampling=resampling)
 
-    r10 = info[0][0]
-    r20 = info[0][1]
-    red = rasterio.open(r10['B04'], driver='JP2OpenJPEG')
-    b8a = rasterio.open(r20['B8A'], driver='JP2OpenJPEG')
-    b12 = rasterio.open(r20['B12'], driver='JP2OpenJPEG')
-    with rasterio.open(filepath, 'w', driver='Gtiff', width=red.width,
-                       height=red.height, count=3,
-                       crs=red.crs, transform=red.transform,
-                       dtype=red.dtypes[0]) as image:
 
-        image.write(red.read(1), 1)
-        image.write(b8a.read(1), 2)
-        image.write(b12.read(1), 3)
-        image.close()
-
-
-def create_rgb(info, project, output):
+def create_rgb(info, project, output, cache=None):
     """create rgb dataset"""
+    create_products(info, project, output, ['RGB'], cache)
 
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'RGB.tiff'))
-
-    r10 = info[0][0]
-    blue = rasterio.open(r10['B02'], driver='JP2OpenJPEG')
-    green = rasterio.open(r10['B03'], driver='JP2OpenJPEG')
-    red = rasterio.open(r10['B04'], driver='JP2OpenJPEG')
-    with rasterio.open(filepath, 'w', driver='Gtiff', width=red.width,
-                       height=red.height, count=3, crs=red.crs,
-                       transform=red.transform,
-                       dtype=red.dtypes[0]) as rgb:
 
-        rgb.write(red.read(1), 1)
-        rgb.write(green.read(1), 2)
-        rgb.write(blue.read(1), 3)
-        rgb.close()
-
-
-def create_geo(info, project, output):
+def create_geo(info, project, output, cache=None, resampling='bilinear'):
     """
     The geology band combination is a neat application for finding geological
     features. This includes faults, lithology, and geological formations.
     By leveraging the SWIR-2 (B12), SWIR-1 (B11), and blue (B2) bands,
     geologists tend to use this Sentinel band combination for their analysis.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'GEO.tiff'))
-
-    r10 = info[0][0]
-    r20 = info[0][1]
-    blue = rasterio.open(r10['B02'], driver='JP2OpenJPEG')
-    b11 = rasterio.open(r20['B11'], driver='JP2OpenJPEG')
-    b12 = rasterio.open(r20['B12'], driver='JP2OpenJPEG')
-    with rasterio.open(filepath, 'w', driver='Gtiff', width=blue.width,
-                       height=blue.height, count=3, crs=blue.crs,
-                       transform=blue.transform,
-                       dtype=blue.dtypes[0]) as rgb:
+    create_products(info, project, output, ['GEO'], cache,
+                    resampling=resampling)
 
-        rgb.write(blue.read(1), 1)
-        rgb.write(b11.read(1), 2)
-        rgb.write(b12.read(1), 3)
-        rgb.close()
 
-
-def create_bathy(info, project, output):
+def create_bathy(info, project, output, cache=None, resampling='bilinear'):
     """
     As the name implies, the bathymetric band combination is good for coastal
     studies. The bathymetric band combination uses the red (B4), green (B3),
     and coastal band (B1). By using the coastal aerosol band, it’s good for
     estimating suspended sediment in the water.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'BAT.tiff'))
-
-    r10 = info[0][0]
-    r60 = info[0][2]
-    green = rasterio.open(r10['B03'], driver='JP2OpenJPEG')
-    red = rasterio.open(r10['B04'], driver='JP2OpenJPEG')
-    b01 = rasterio.open(r60['B01'], driver='JP2OpenJPEG')
-    with rasterio.open(filepath, 'w', driver='Gtiff', width=red.width,
-                       height=red.height, count=3, crs=red.crs,
-                       transform=red.transform,
-                       dtype=red.dtypes[0]) as rgb:
-        rgb.write(red.read(1), 1)
-        rgb.write(green.read(1), 2)
-        rgb.write(b01.read(1), 3)
-        rgb.close()
+    create_products(info, project, output, ['BAT'], cache,
+                    resampling=resampling)
 
 
-def create_agri(info, project, output):
+def create_agri(info, project, output, cache=None, resampling='bilinear'):
     """
     The agriculture band combination uses SWIR-1 (B11), near-infrared (B8),
     and blue (B2). It’s mostly used to monitor the health of crops because
@@ -268,23 +486,8 @@ def create_agri(info, project, output):
     particularly good at highlighting dense vegetation which appears as dark
     green.
     """
-    filepath = path.join(output, '{}_{}'.format(
-        project.project_name, 'AGRI.tiff'))
-
-    r10 = info[0][0]
-    r20 = info[0][1]
-    blue = rasterio.open(r10['B02'], driver='JP2OpenJPEG')
-    b11 = rasterio.open(r20['B11'], driver='JP2OpenJPEG')
-    b08 = rasterio.open(r10['B08'], driver='JP2OpenJPEG')
-    with rasterio.open(filepath, 'w', driver='Gtiff', width=blue.width,
-                       height=blue.height, count=3, crs=blue.crs,
-                       transform=blue.transform,
-                       dtype=blue.dtypes[0]) as rgb:
-
-        rgb.write(blue.read(1), 1)
-        rgb.write(b11.read(1), 2)
-        rgb.write(b08.read(1), 3)
-        rgb.close()
+    create_products(info, project, output, ['AGRI'], cache,
+                    resampling=resampling)
 
 
 def create_all_bands(info, project, output):
@@ -292,32 +495,21 @@ def create_all_bands(info, project, output):
     file_path = path.join(output, '{}_{}'.format(
         project.project_name, 'ALLBANDS.tiff'))
 
+    band_names = list(info[0][0].keys())
     addresses = list(info[0][0].values())
     meta = ''
     with rasterio.open(addresses[0]) as src:
         meta = src.meta
 
+    meta = get_output_profile('uint16', meta)
     meta.update(count=len(info[0][0]))
-    with rasterio.open(file_path, 'w', **meta) as dst:
-        for ids, layer in enumerate(addresses, start=1):
-            with rasterio.open(layer) as src1:
-                dst.write_band(ids, src1.read(1).astype('uint16'))
-
-
-def __convert_three_bands(file_path, image_type):
-    """
-    Used internaly to help with saving to png
-    """
-    src = rasterio.open(file_path)
-    data = src.read()
-    stack1 = __normalize_array(data[0], image_type)
-    stack2 = __normalize_array(data[1], image_type)
-    stack3 = __normalize_array(data[2], image_type)
-    normedd = np.dstack((stack1, stack2, stack3))
-    plt.imshow(normedd)
-    output = file_path.replace('tiff', 'png')
-    plt.axis('off')
-    plt.savefig(output, dpi=2000, bbox_inches='tight', pad_inches=0)
+    dst = rasterio.open(file_path, 'w', **meta)
+    for ids, layer in enumerate(addresses, start=1):
+        with rasterio.open(layer) as src1:
+            dst.write_band(ids, src1.read(1).astype('uint16'))
+        # lets RasterData select the bands by name
+        dst.set_band_description(ids, band_names[ids - 1])
+    close_output(dst)
 
 
 def convert_to_png(project, image_type, cropped=True, clustering=False,
@@ -326,29 +518,16 @@ def convert_to_png(project, image_type, cropped=True, clustering=False,
     Converts tiff image to png and saves it
     """
     if not clustering:
-        filepath = project.getImagePath(image_type, cropped)
-
-        if path.exists(filepath.replace('tiff', 'png')):
+        filepath = project.get_image_paths(image_type, cropped)
+        output = filepath.replace('tiff', 'png')
+        if path.exists(output):
             return
 
-        if image_type.lower() in THREEBANDS:
-            __convert_three_bands(filepath, image_type)
-            return
-
-        src = rasterio.open(filepath)
-        data = src.read()
-        plt.imshow(data[0], cmap='RdYlGn')
-        output = filepath.replace('tiff', 'png')
-        plt.axis('off')
-        plt.savefig(output, dpi=1000, bbox_inches='tight', pad_inches=0)
+        bands, cmap, vmin, vmax = get_render_options(image_type)
+        export_image(filepath, output, bands, cmap, vmin, vmax)
 
     if clustering:
-        filepath = project.get_clustering_path(image_type,
-                                               clusters, cropped)
+        filepath = project.get_clustering_path(cropped)
         output = filepath.replace('tiff', 'png')
-        img = rasterio.open(filepath)
-
-        data = img.read()
-        plt.imshow(data[0], cmap='RdYlGn')
-        plt.axis('off')
-        plt.savefig(output, dpi=1000, bbox_inches='tight', pad_inches=0)
+        export_image(filepath, output, [1], 'RdYlGn', 0,
+                     clusters - 1 if clusters > 1 else None)
@@ -0,0 +1,70 @@
+"""
+Manifest keeps track of the products built for a date, with the inputs and
+parameters they were built from, so that builds only redo stale products.
+"""
+import json
+import os
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_signature(filepath):
+    """
+    Returns the size and modification time of a file, None if it is missing.
+    """
+    if not os.path.exists(filepath):
+        return None
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class Manifest():
+    """
+    Per date record of every product's inputs, parameters and outputs.
+    """
+    def __init__(self, folder):
+        self.file_path = os.path.join(folder, MANIFEST_NAME)
+        self.products = {}
+        if os.path.exists(self.file_path):
+            with open(self.file_path, 'r') as manifest_file:
+                self.products = json.load(manifest_file)
+
+    def is_up_to_date(self, product, inputs, parameters, outputs):
+        """
+        Returns true if the product was recorded with the same inputs and
+        parameters and its outputs weren't modified or removed since.
+        """
+        entry = self.products.get(product)
+        if entry is None:
+            return False
+
+        return (entry['parameters'] == parameters and
+                entry['inputs'] == self.__get_signatures(inputs) and
+                entry['outputs'] == self.__get_signatures(outputs) and
+                None not in entry['outputs'].values())
+
+    def record(self, product, inputs, parameters, outputs):
+        """
+        Records a freshly built product, call save to write it to disk.
+        """
+        self.products[product] = {
+            'inputs': self.__get_signatures(inputs),
+            'parameters': parameters,
+            'outputs': self.__get_signatures(outputs),
+        }
+
+    def save(self):
+        """
+        Writes the manifest next to the products.
+        """
+        tmp_path = '{}.{}.tmp'.format(self.file_path, os.getpid())
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.products, manifest_file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.file_path)
+
+    @staticmethod
+    def __get_signatures(filepaths):
+        """
+        Returns the signature of each file keyed by its path.
+        """
+        return {filepath: get_signature(filepath) for filepath in filepaths}
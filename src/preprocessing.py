@@ -2,64 +2,473 @@
 Utility to preprocess the raster data before applying
 other data driven algorithms.
 """
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import gdal
-from sklearn.preprocessing import StandardScaler
-from scipy.ndimage import gaussian_filter
-from skimage.restoration import denoise_bilateral, estimate_sigma
+from scipy.ndimage import gaussian_filter, uniform_filter
+from skimage.restoration import estimate_sigma
+from manifest import get_signature
 
+# Minimum side of a tile in pixels, tiles are grown from the gdal block size
+# until they reach it.
+TILE_SIZE = 1024
 
-def get_raster_data(image_path, dtype=np.float32):
+GDAL_TYPES = {
+    np.dtype(np.uint8): gdal.GDT_Byte,
+    np.dtype(np.uint16): gdal.GDT_UInt16,
+    np.dtype(np.int16): gdal.GDT_Int16,
+    np.dtype(np.uint32): gdal.GDT_UInt32,
+    np.dtype(np.int32): gdal.GDT_Int32,
+    np.dtype(np.float32): gdal.GDT_Float32,
+    np.dtype(np.float64): gdal.GDT_Float64,
+}
+
+# Folder created next to the images to hold their cached copies and
+# statistics
+CACHE_FOLDER = '.raster_cache'
+
+# Suffix of the sidecar file caching the band statistics of an image
+STATISTICS_SUFFIX = '.stats.json'
+
+# Side of the square the noise of a band is estimated on
+NOISE_SAMPLE_SIZE = 1024
+
+Window = namedtuple('Window', ['x_off', 'y_off', 'width', 'height'])
+
+
+def get_raster_data(image_path, dtype=np.float32, bands=None):
     """
     Return raster data as a numpy array
+    bands: band numbers or descriptions to read, all if None
     """
     raster_data = gdal.Open(image_path)
-    nbands = raster_data.RasterCount
-    data = np.empty((raster_data.RasterXSize*raster_data.RasterYSize, nbands))
+    bands = get_band_numbers(raster_data, bands)
+    data = np.empty((raster_data.RasterYSize, raster_data.RasterXSize,
+                     len(bands)), dtype=dtype)
+    fill_raster_array(raster_data, data, bands)
+
+    return data.reshape(-1, data.shape[-1])
+
+
+def get_block_windows(raster_data, halo=0, tile_size=TILE_SIZE):
+    """
+    Yields (window, padded_window) tuples covering the gdal dataset.
+    Windows are aligned to the block size of the first band and span
+    a multiple of it at least tile_size pixels wide, the padded window
+    grows the window by halo pixels on each side, clipped to the raster.
+    """
+    block_x, block_y = raster_data.GetRasterBand(1).GetBlockSize()
+    step_x = block_x * max(1, tile_size // block_x)
+    step_y = block_y * max(1, tile_size // block_y)
+    width = raster_data.RasterXSize
+    height = raster_data.RasterYSize
+
+    for y_off in range(0, height, step_y):
+        for x_off in range(0, width, step_x):
+            window = Window(x_off, y_off, min(step_x, width - x_off),
+                            min(step_y, height - y_off))
+            yield window, pad_window(window, halo, width, height)
+
+
+def pad_window(window, halo, width, height):
+    """
+    Returns the window grown by halo pixels on each side without going
+    past the width and height of the raster.
+    """
+    x_off = max(0, window.x_off - halo)
+    y_off = max(0, window.y_off - halo)
+    x_end = min(width, window.x_off + window.width + halo)
+    y_end = min(height, window.y_off + window.height + halo)
+    return Window(x_off, y_off, x_end - x_off, y_end - y_off)
+
+
+def crop_halo(block, window, padded_window):
+    """
+    Removes the halo of a block read with padded_window so that only the
+    pixels of window remain.
+    """
+    top = window.y_off - padded_window.y_off
+    left = window.x_off - padded_window.x_off
+    return block[top:top + window.height, left:left + window.width]
+
+
+def get_band_numbers(raster_data, bands=None):
+    """
+    Returns the gdal band numbers of a selection of bands, bands can be
+    given by number (starting at 1) or by description. Every band of the
+    dataset is returned when bands is None.
+    """
+    if bands is None:
+        return list(range(1, raster_data.RasterCount + 1))
+
+    descriptions = [raster_data.GetRasterBand(i).GetDescription()
+                    for i in range(1, raster_data.RasterCount + 1)]
+    numbers = []
+    for band in bands:
+        if isinstance(band, str):
+            if band not in descriptions:
+                raise ValueError('band {} not found in raster'.format(band))
+            band = descriptions.index(band) + 1
+        numbers.append(int(band))
 
-    for i in range(1, nbands+1):
-        band = raster_data.GetRasterBand(i).ReadAsArray()
-        data[:, i-1] = band.flatten()
+    return numbers
 
-    if dtype == np.float32:
-        return np.float32(data)
 
+def read_window(raster_data, window, dtype=np.float32, bands=None):
+    """
+    Reads a window of the selected bands (all by default) of the gdal
+    dataset as a (height, width, bands) array. The bands are interleaved by
+    gdal directly in the requested type, the returned array is read only.
+    Bands with a scale or offset tag, such as int16 indices, are returned
+    unscaled as a new array.
+    """
+    dtype = np.dtype(dtype)
+    bands = get_band_numbers(raster_data, bands)
+    nbands = len(bands)
+    buffer = raster_data.ReadRaster(
+        window.x_off, window.y_off, window.width, window.height,
+        buf_type=GDAL_TYPES[dtype], band_list=bands,
+        buf_pixel_space=dtype.itemsize * nbands,
+        buf_line_space=dtype.itemsize * nbands * window.width,
+        buf_band_space=dtype.itemsize)
+
+    data = np.frombuffer(buffer, dtype=dtype).reshape(
+        window.height, window.width, nbands)
+
+    scales, offsets = get_band_scales(raster_data, bands)
+    if np.any(scales != 1) or np.any(offsets != 0):
+        data = (data * scales + offsets).astype(dtype)
     return data
 
 
-def get_normalized_bands(data):
+def get_band_scales(raster_data, bands):
+    """
+    Returns the scale and offset arrays turning the stored values of the
+    bands into the values they represent.
+    """
+    scales = [raster_data.GetRasterBand(band).GetScale() for band in bands]
+    offsets = [raster_data.GetRasterBand(band).GetOffset() for band in bands]
+    return (np.array([1 if scale is None else scale for scale in scales]),
+            np.array([0 if offset is None else offset for offset in offsets]))
+
+
+def fill_raster_array(raster_data, out, bands=None, tile_size=TILE_SIZE):
+    """
+    Fills a preallocated (height, width, bands) array with the selected
+    bands of the gdal dataset one tile at a time, out can be a numpy
+    memory map.
+    """
+    bands = get_band_numbers(raster_data, bands)
+    for window, _ in get_block_windows(raster_data, tile_size=tile_size):
+        out[window.y_off:window.y_off + window.height,
+            window.x_off:window.x_off + window.width] = read_window(
+                raster_data, window, out.dtype, bands)
+
+    return out
+
+
+def get_raster_blocks(image_path, halo=0, dtype=np.float32, flatten=False,
+                      tile_size=TILE_SIZE, bands=None):
+    """
+    Streaming counterpart of get_raster_data, yields
+    (window, padded_window, data) for every tile of the raster so that only
+    one tile is in memory at once.
+        halo: number of neighbouring pixels read around each window
+        flatten: if true data is returned as a (pixels, bands) array
+        bands: band numbers or descriptions to read, all if None
+    """
+    raster_data = gdal.Open(image_path)
+    bands = get_band_numbers(raster_data, bands)
+    for window, padded_window in get_block_windows(raster_data, halo,
+                                                   tile_size):
+        data = read_window(raster_data, padded_window, dtype, bands)
+        if flatten:
+            data = data.reshape(-1, data.shape[-1])
+        yield window, padded_window, data
+
+
+def get_band_statistics(image_path, bands=None, tile_size=TILE_SIZE):
     """
-    Receives tiff image path and return normalized numpy array.
+    Returns the mean and standard deviation of every band of the raster.
+    They are computed in a single streaming pass over its tiles and cached
+    in a sidecar file in the cache folder next to the image, reused as long
+    as the image isn't modified.
+        bands: band numbers or descriptions to use, all if None
     """
-    scaler = StandardScaler()
-    for band in range(data.shape[-1]):
-        data[:, :, band] = scaler.fit_transform(data[:, :, band])
+    bands = get_band_numbers(gdal.Open(image_path), bands)
+    folder, name = os.path.split(image_path)
+    sidecar_path = os.path.join(folder, CACHE_FOLDER,
+                                name + STATISTICS_SUFFIX)
+    signature = get_signature(image_path)
+    cached = {}
+    if os.path.exists(sidecar_path):
+        with open(sidecar_path, 'r') as sidecar:
+            saved = json.load(sidecar)
+        if saved['signature'] == signature:
+            cached = saved['bands']
+
+    missing = [band for band in bands if str(band) not in cached]
+    if missing:
+        count, mean, m2 = accumulate_moments(
+            get_raster_blocks(image_path, dtype=np.float64, flatten=True,
+                              tile_size=tile_size, bands=missing))
+        for index, band in enumerate(missing):
+            cached[str(band)] = {'count': int(count),
+                                 'mean': float(mean[index]),
+                                 'm2': float(m2[index])}
+        save_statistics(sidecar_path, signature, cached)
+
+    mean = np.array([cached[str(band)]['mean'] for band in bands])
+    std = np.sqrt(np.array([cached[str(band)]['m2'] / cached[str(band)]
+                            ['count'] for band in bands]))
+    return mean, std
 
+
+def accumulate_moments(blocks):
+    """
+    Returns the count, mean and sum of squared deviations of every band of
+    the (pixels, bands) data of the blocks. The moments of each block are
+    merged with the running ones using Chan's parallel update of Welford's
+    algorithm, which doesn't lose precision like a sum of squares does.
+    Blocks are accumulated in float64 whatever their type.
+    """
+    count = 0
+    mean = 0
+    m2 = 0
+    for _, _, data in blocks:
+        block_count = data.shape[0]
+        if block_count == 0:
+            continue
+        data = np.asarray(data, dtype=np.float64)
+        block_mean = data.mean(axis=0)
+        block_m2 = np.square(data - block_mean).sum(axis=0)
+
+        total = count + block_count
+        delta = block_mean - mean
+        mean = mean + delta * block_count / total
+        m2 = m2 + block_m2 + np.square(delta) * count * block_count / total
+        count = total
+
+    return count, mean, m2
+
+
+def save_statistics(sidecar_path, signature, statistics):
+    """
+    Writes the band statistics of an image to its sidecar file, images in
+    read only folders simply aren't cached.
+    """
+    tmp_path = '{}.{}.tmp'.format(sidecar_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        with open(tmp_path, 'w') as sidecar:
+            json.dump({'signature': signature, 'bands': statistics}, sidecar)
+        os.replace(tmp_path, sidecar_path)
+    except OSError:
+        pass
+
+
+def standardize(data, mean, std):
+    """
+    Returns the (..., bands) data standardized with per band statistics as
+    a new float32 array, constant bands are only centered.
+    """
+    mean = np.asarray(mean, dtype=np.float32)
+    std = np.where(std == 0, 1, std).astype(np.float32)
+    standardized = np.subtract(data, mean, dtype=np.float32)
+    standardized /= std
+    return standardized
+
+
+def sample_pixels(data, sample_size, strategy='uniform', random_state=0):
+    """
+    Returns about sample_size pixels of a (height, width, bands) array as a
+    (pixels, bands) array.
+        strategy: 'uniform' takes the pixels on a regular grid spanning the
+                  scene, 'stratified' splits the scene in blocks and draws
+                  the same number of random pixels from each of them
+    """
+    height, width, nbands = data.shape
+    if sample_size >= height * width:
+        return np.ascontiguousarray(data).reshape(-1, nbands)
+
+    if strategy == 'uniform':
+        step = max(1, int(np.sqrt(height * width / sample_size)))
+        sample = data[step // 2::step, step // 2::step]
+        return np.ascontiguousarray(sample).reshape(-1, nbands)
+
+    if strategy != 'stratified':
+        raise ValueError('unknown sampling strategy {}'.format(strategy))
+
+    rng = np.random.default_rng(random_state)
+    strata = int(min(16, height, width))
+    per_stratum = int(np.ceil(sample_size / strata ** 2))
+    row_edges = np.linspace(0, height, strata + 1).astype(int)
+    col_edges = np.linspace(0, width, strata + 1).astype(int)
+    rows = []
+    cols = []
+    for i in range(strata):
+        for j in range(strata):
+            rows.append(rng.integers(row_edges[i], row_edges[i + 1],
+                                     per_stratum))
+            cols.append(rng.integers(col_edges[j], col_edges[j + 1],
+                                     per_stratum))
+
+    return data[np.concatenate(rows), np.concatenate(cols)]
+
+
+def compress_pixels(features):
+    """
+    Deduplicates the rows of a (pixels, bands) array. Returns the unique
+    pixel vectors, how many times each of them occurs and the inverse index
+    such that unique[inverse] rebuilds the pixels.
+    """
+    features = np.ascontiguousarray(features)
+    rows = features.view(np.dtype(
+        (np.void, features.dtype.itemsize * features.shape[1]))).ravel()
+    _, index, inverse, counts = np.unique(rows, return_index=True,
+                                          return_inverse=True,
+                                          return_counts=True)
+    return features[index], counts, inverse.ravel()
+
+
+def resample_weighted(unique, counts, sample_size, random_state=0):
+    """
+    Draws sample_size pixels among unique pixel vectors with a probability
+    proportional to their counts, standing in for sample weights with
+    models that don't accept them.
+    """
+    rng = np.random.default_rng(random_state)
+    selection = rng.choice(len(unique), size=sample_size,
+                           p=counts / counts.sum())
+    return unique[selection]
+
+
+def get_normalized_bands(data):
+    """
+    Standardizes every band of the (..., bands) array in place with the
+    mean and standard deviation of the band and returns it. The moments
+    are accumulated in float64 over blocks of TILE_SIZE ** 2 pixels.
+    """
+    flat_data = data.reshape(-1, data.shape[-1])
+    count, mean, m2 = accumulate_moments(
+        (None, None, flat_data[start:start + TILE_SIZE ** 2])
+        for start in range(0, len(flat_data), TILE_SIZE ** 2))
+    std = np.sqrt(m2 / count)
+    data -= mean.astype(data.dtype)
+    data /= np.where(std == 0, 1, std).astype(data.dtype)
     return data
 
 
-def apply_gaussian_blur(data, sigma):
+def apply_gaussian_blur(data, sigma, tile_size=TILE_SIZE, workers=None):
     """
-    Applies blurring affect on raster data to remove noise.
+    Applies blurring affect on raster data to remove noise, returns the
+    blurred (height, width, bands) data as a new float32 array.
+    The bands of every tile are filtered concurrently, each tile being read
+    with a halo as wide as the gaussian kernel so that the result matches
+    the filter of the whole array.
         Sigma: Stanard deviation of the gaussian kernel
+        tile_size: side of the tiles in pixels
+        workers: number of threads, chosen by the executor if None
     """
-    for band in range(data.shape[-1]):
-        data[:, :, band] = gaussian_filter(data[:, :, band], sigma)
+    height, width, nbands = data.shape
+    halo = int(4 * sigma + 0.5)
+    blurred = np.empty(data.shape, dtype=np.float32)
 
-    return data
+    def blur(task):
+        window, band = task
+        padded_window = pad_window(window, halo, width, height)
+        block = np.asarray(data[
+            padded_window.y_off:padded_window.y_off + padded_window.height,
+            padded_window.x_off:padded_window.x_off + padded_window.width,
+            band], dtype=np.float32)
+        block = gaussian_filter(block, sigma)
+        blurred[window.y_off:window.y_off + window.height,
+                window.x_off:window.x_off + window.width,
+                band] = crop_halo(block, window, padded_window)
+
+    tasks = [(window, band) for window in get_tile_windows(width, height,
+                                                           tile_size)
+             for band in range(nbands)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(blur, tasks))
 
+    return blurred
 
-def apply_bilateral_filter(data):
+
+def get_tile_windows(width, height, tile_size=TILE_SIZE):
     """
-    Applies bilateral filter to numpy array are return flattened array.
-    Allows the removal of noise while still keeping the contour.
+    Returns the windows of a grid of tile_size tiles covering an array.
     """
-    sigma_estimation = estimate_sigma(data, multichannel=True,
-                                      average_sigmas=True)
+    return [Window(x_off, y_off, min(tile_size, width - x_off),
+                   min(tile_size, height - y_off))
+            for y_off in range(0, height, tile_size)
+            for x_off in range(0, width, tile_size)]
 
-    for band in range(data.shape[-1]):
-        sigma_estimation = estimate_sigma(band, average_sigmas=True)
-        data[:, :, band] = denoise_bilateral(band,
-                                             sigma_color=sigma_estimation)
 
-    return data
+def apply_guided_filter(data, radius=2, strength=3, tile_size=TILE_SIZE,
+                        workers=None):
+    """
+    Applies an edge preserving denoise on raster data, each band being its
+    own guide in a guided filter. Returns the denoised (height, width,
+    bands) data as a new float32 array. Tiles are read with a halo covering
+    the two box filters and filtered concurrently.
+        radius: radius of the box filters in pixels
+        strength: variations smaller than strength times the noise of the
+                  band, estimated once per band, are smoothed out
+        tile_size: side of the tiles in pixels
+        workers: number of threads, chosen by the executor if None
+    """
+    height, width, nbands = data.shape
+    halo = 2 * radius
+    eps = [(strength * estimate_band_noise(data[:, :, band])) ** 2
+           for band in range(nbands)]
+    denoised = np.empty(data.shape, dtype=np.float32)
+
+    def denoise(task):
+        window, band = task
+        padded_window = pad_window(window, halo, width, height)
+        block = np.asarray(data[
+            padded_window.y_off:padded_window.y_off + padded_window.height,
+            padded_window.x_off:padded_window.x_off + padded_window.width,
+            band], dtype=np.float32)
+        block = guided_filter(block, radius, eps[band])
+        denoised[window.y_off:window.y_off + window.height,
+                 window.x_off:window.x_off + window.width,
+                 band] = crop_halo(block, window, padded_window)
+
+    tasks = [(window, band) for window in get_tile_windows(width, height,
+                                                           tile_size)
+             for band in range(nbands)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(denoise, tasks))
+
+    return denoised
+
+
+def guided_filter(band, radius, eps):
+    """
+    Self guided filter of a 2-D float32 array, computed with box filters.
+        eps: variance under which a neighbourhood is considered flat
+    """
+    size = 2 * radius + 1
+    mean = uniform_filter(band, size)
+    variance = uniform_filter(band * band, size) - mean * mean
+    scale = variance / (variance + eps)
+    offset = mean - scale * mean
+    return uniform_filter(scale, size) * band + uniform_filter(offset, size)
+
+
+def estimate_band_noise(band, sample_size=NOISE_SAMPLE_SIZE):
+    """
+    Estimates the standard deviation of the noise of a 2-D band from a
+    sample_size square at its center.
+    """
+    height, width = band.shape
+    top = max(0, (height - sample_size) // 2)
+    left = max(0, (width - sample_size) // 2)
+    sample = np.asarray(band[top:top + sample_size, left:left + sample_size],
+                        dtype=np.float32)
+    return estimate_sigma(sample)
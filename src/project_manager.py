@@ -4,12 +4,14 @@ creation of different project specific folder,
 unzipping the data and keeping track of the image paths
 """
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from shutil import copy, move
 from zipfile import ZipFile
 import pandas as pd
 from kml_handler import KmlHandler
 from api_session import ApiSession
 import image_creator
+from exporter import MOSAICS_FOLDER
 
 logging_path = ''
 
@@ -22,6 +24,16 @@ def get_project_list(self):
     return [folder for folder in sub_directories if os.listdir(folder)]
 
 
+def report_progress(done, total, date, error=None):
+    """
+    Prints the progress of a batch of scenes.
+    """
+    if error is None:
+        print('({}/{}) {} done'.format(done, total, date))
+    else:
+        print('({}/{}) {} failed: {}'.format(done, total, date, error))
+
+
 class ProjectManager():
     """
     ProjectManager creates project folder structure and helps with keeping
@@ -38,6 +50,15 @@ class ProjectManager():
         if project_name != '':
             self.add_project(project_name)
 
+    def __getstate__(self):
+        """
+        Drops the api session when the project is sent to worker processes,
+        workers only build imagery and never query the api.
+        """
+        state = self.__dict__.copy()
+        state['api_session'] = None
+        return state
+
     def create_project_folder(self):
         """
         Creates the project folder where all project will be stored.
@@ -230,28 +251,86 @@ class ProjectManager():
 
             os.mkdir(image_path + selected_file + os.sep + 'cropped')
 
-    def batch_create_imagery(self):
+    def batch_create_imagery(self, workers=1, cache_bytes=None, aoi=False,
+                             index_dtype='float32'):
         """
         Calls rasterData create_images for all data present
         for the given project. Creates data conveniently
-        """
-        data_path = self.get_download_path()
-        all_dates = os.listdir(data_path)
-
+        workers: number of processes building scenes concurrently
+        cache_bytes: band cache budget of each scene being built
+        aoi: if true only the area of interest of the kml file is processed
+             and the cropped images are created directly
+        index_dtype: type of the index products, 'float32' or 'int16'
+        Returns a dictionary of the dates that failed and their error, a
+        failing scene doesn't stop the others from being built.
+        """
+        all_dates = self.get_dates()
+        failures = {}
+        indices = []
         for data_file in all_dates:
-            tmp_info = self.__create_resolution_index(data_file)
-            image_creator.create_batch_images(tmp_info, self)
+            try:
+                indices.append((data_file,
+                                self.__create_resolution_index(data_file)))
+            except Exception as error:
+                failures[data_file] = error
+                report_progress(len(failures), len(all_dates), data_file,
+                                error)
+
+        done = len(failures)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(image_creator.create_batch_images,
+                                           tmp_info, self, cache_bytes, aoi,
+                                           index_dtype):
+                           data_file for data_file, tmp_info in indices}
+                for future in as_completed(futures):
+                    data_file = futures[future]
+                    try:
+                        future.result()
+                    except Exception as error:
+                        failures[data_file] = error
+                    done += 1
+                    report_progress(done, len(all_dates), data_file,
+                                    failures.get(data_file))
+        else:
+            for data_file, tmp_info in indices:
+                try:
+                    image_creator.create_batch_images(tmp_info, self,
+                                                      cache_bytes, aoi,
+                                                      index_dtype)
+                except Exception as error:
+                    failures[data_file] = error
+                done += 1
+                report_progress(done, len(all_dates), data_file,
+                                failures.get(data_file))
+
+        return failures
 
     def __create_resolution_index(self, selected_file):
         """
         Given a data location return a dictionary with all the necessary
         information.
         """
-        data_path = self.get_download_path()
         image_path = self.get_images_folder_path()
         self.create_imagery_folder(selected_file)
+        return (self.get_band_paths(selected_file),
+                image_path + selected_file + os.sep)
 
-        data_folder = data_path + selected_file + os.sep
+    def get_dates(self):
+        """
+        Returns the sorted dates downloaded for the project.
+        """
+        data_path = self.get_download_path()
+        return sorted(date for date in os.listdir(data_path)
+                      if os.path.isdir(data_path + date))
+
+    def get_band_paths(self, date):
+        """
+        Returns the band paths of a downloaded date as a list of one
+        dictionary per resolution (10m, 20m, 60m) keyed by band name, such
+        as 'B04' or 'TCI'. Nothing is asked nor created.
+        """
+        data_folder = self.get_download_path() + date + os.sep
         granule_path = data_folder + 'GRANULE' + os.sep
         granule_next = granule_path + os.listdir(granule_path)[0] + os.sep
         final_folder = granule_next + 'IMG_DATA' + os.sep
@@ -268,7 +347,7 @@ class ProjectManager():
 
             references.append(resolution_dict)
 
-        return (references, image_path + selected_file + os.sep)
+        return references
 
     def get_resolution_paths(self):
         """
@@ -286,40 +365,29 @@ class ProjectManager():
         selected = input()
 
         self.create_imagery_folder(all_dates[int(selected)])
+        return (self.get_band_paths(all_dates[int(selected)]),
+                image_path + all_dates[int(selected)] + os.sep)
 
-        data_folder = data_path + all_dates[int(selected)] + os.sep
-        granule_path = data_folder + 'GRANULE' + os.sep
-        granule_next = granule_path + os.listdir(granule_path)[0] + os.sep
-        final_folder = granule_next + 'IMG_DATA' + os.sep
-
-        references = []
-        resolutions = ['R10m', 'R20m', 'R60m']
-
-        for res in resolutions:
-            resolution_dict = {}
-            for data in os.listdir(final_folder + os.sep + res):
-                key = data.split('_')[2]
-                value = final_folder + res + os.sep + data
-                resolution_dict[key] = value
-
-            references.append(resolution_dict)
-        return (references, image_path + all_dates[int(selected)] + os.sep)
+    def get_kml_path(self):
+        """
+        Returns the location of the project kml file.
+        """
+        return (self.projects_folder + os.sep + self.project_name +
+                os.sep + self.project_name + '.kml')
 
     def create_projection(self, projection_type):
         """
         Creates and returns projection from the geometric footprint for the
         project with a specific projection type.
         """
-        file_path = (self.projects_folder + os.sep + self.project_name +
-                     os.sep + self.project_name + '.kml')
+        file_path = self.get_kml_path()
         return self.kml_handler.create_projection(projection_type, file_path)
 
     def get_bounding_box(self, projection_type):
         """
         Returns bounding box around area of interest.
         """
-        file_path = (self.projects_folder + os.sep + self.project_name +
-                     os.sep + self.project_name + '.kml')
+        file_path = self.get_kml_path()
         return self.kml_handler.create_bounding_box(projection_type, file_path)
 
     def get_image_paths(self, image_type, cropped=True, get_date=False):
@@ -327,7 +395,8 @@ class ProjectManager():
         Returns all the image paths and ask you what path youre looking for.
         """
         image_path = self.get_images_folder_path()
-        all_dates = os.listdir(image_path)
+        all_dates = [date for date in os.listdir(image_path)
+                     if date != MOSAICS_FOLDER and not date.startswith('.')]
         all_dates.sort()
         print('Select one of the dates to view the Images:')
 
@@ -359,7 +428,8 @@ class ProjectManager():
         your interested in.
         """
         clustering_path = self.get_clustering_folder_path()
-        all_dates = os.listdir(clustering_path)
+        all_dates = [date for date in os.listdir(clustering_path)
+                     if not date.startswith('.')]
         all_dates.sort()
         print('Select one of the dates to view the clustering:')
 
@@ -373,7 +443,8 @@ class ProjectManager():
         if cropped:
             selection_path += 'cropped' + os.sep
 
-        all_results = os.listdir(selection_path)
+        all_results = [result for result in os.listdir(selection_path)
+                       if not result.startswith('.')]
 
         print('Select one of the images to view')
 
@@ -391,7 +462,8 @@ class ProjectManager():
         Prints and asks for selected date
         """
         clustering_folder = self.get_clustering_folder_path()
-        all_dates = os.listdir(clustering_folder)
+        all_dates = [date for date in os.listdir(clustering_folder)
+                     if not date.startswith('.')]
         all_dates.sort()
 
         print('Select one of the following dates')
@@ -2,26 +2,74 @@
 RasterData is a Wrapper for the raster data that the machine learning
 algorithms and the preprocessing will be done on.
 """
+import os
 import numpy as np
-from preprocessing import get_normalized_bands, apply_gaussian_blur
+from preprocessing import apply_gaussian_blur, apply_guided_filter
+from preprocessing import standardize, get_normalized_bands
+from preprocessing import get_raster_blocks, fill_raster_array, TILE_SIZE
+from preprocessing import get_band_numbers, get_band_statistics
+from preprocessing import CACHE_FOLDER
+from raster_pipeline import RasterPipeline
 import gdal
 
 
 class RasterData():
     """RasterData class """
-    def __init__(self, image_path):
+    def __init__(self, image_path, dtype=np.float64, memmap=False,
+                 bands=None):
+        """
+        The data is only read from the raster on first access of array,
+        before that only its metadata is known and it can be streamed with
+        iterate_blocks.
+        dtype: type of the array holding the data
+        memmap: if true the array is a memory map of an on-disk copy of the
+                raster, decoded once and shared by every later open
+        bands: band numbers (starting at 1) or band descriptions to load,
+               every band is loaded if None
+        """
         self.org_image_path = image_path
-        self.array = self.get_array_from_raster()
-        self.height = self.array.shape[0]
-        self.width = self.array.shape[1]
+        self.dtype = np.dtype(dtype)
+        self.memmap = memmap
+        raster_data = gdal.Open(image_path)
+        self.height = raster_data.RasterYSize
+        self.width = raster_data.RasterXSize
+        self.bands = get_band_numbers(raster_data, bands)
         """Shape tuple of the array data"""
-        self.shape = self.array.shape
+        self.shape = (self.height, self.width, len(self.bands))
+        self._array = None
+        """True while array holds the unmodified raster"""
+        self.is_original = False
+        self.flat_cache = (None, None)
+
+    @property
+    def array(self):
+        """
+        Numpy array of the data, read from the raster on first access
+        """
+        if self._array is None:
+            self.reset_raster_data()
+        return self._array
+
+    @array.setter
+    def array(self, data):
+        self._array = data
+        self.is_original = False
+
+    def load_array(self):
+        """
+        Reads the raster in the type and backing store chosen at creation
+        """
+        if self.memmap:
+            return self.get_memmap_from_raster(self.dtype)
+
+        return self.get_array_from_raster(self.dtype)
 
     def reset_raster_data(self):
         """
         Reinitializes the raster_data to the original till file
         """
-        self.array = self.get_array_from_raster()
+        self._array = self.load_array()
+        self.is_original = True
 
     def get_current_shape(self):
         """
@@ -34,17 +82,79 @@ class RasterData():
         """
         Return Numpy array from the raster data
         """
-        raster_data = gdal.Open(self.org_image_path)
-        data = np.empty((raster_data.RasterYSize,
-                         raster_data.RasterXSize, raster_data.RasterCount))
+        data = np.empty(self.shape, dtype=dtype)
+        return fill_raster_array(gdal.Open(self.org_image_path), data,
+                                 self.bands)
 
-        for i in range(1, raster_data.RasterCount+1):
-            band = raster_data.GetRasterBand(i).ReadAsArray()
-            data[:, :, i-1] = band
-        if dtype == np.float32:
-            return np.float32(data)
+    def get_cache_path(self, dtype=np.float64):
+        """
+        Returns the path of the memory mapped copy of the raster for a type
+        """
+        folder, name = os.path.split(self.org_image_path)
+        if len(self.bands) != gdal.Open(self.org_image_path).RasterCount:
+            name += '.b' + '-'.join(str(band) for band in self.bands)
+        return os.path.join(folder, CACHE_FOLDER, '{}.{}.npy'.format(
+            name, np.dtype(dtype).name))
+
+    def get_memmap_from_raster(self, dtype=np.float64):
+        """
+        Returns a copy on write memory map of the raster data. The on-disk
+        copy is created the first time or when the image is newer than it,
+        writes to the returned array never reach the disk.
+        """
+        cache_path = self.get_cache_path(dtype)
+        if (not os.path.exists(cache_path) or os.path.getmtime(cache_path)
+                < os.path.getmtime(self.org_image_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+            cache = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                              dtype=dtype, shape=self.shape)
+            fill_raster_array(gdal.Open(self.org_image_path), cache,
+                              self.bands)
+            cache.flush()
+            del cache
+            os.replace(tmp_path, cache_path)
+
+        return np.load(cache_path, mmap_mode='c')
 
-        return data
+    def iterate_blocks(self, halo=0, dtype=np.float64, flatten=False,
+                       tile_size=TILE_SIZE, normalized=False,
+                       statistics=None):
+        """
+        Yields (window, padded_window, data) tiles read from the original
+        image, aligned to its gdal block size. Only one tile is held in
+        memory at a time, independently of the size of the scene.
+        halo: number of neighbouring pixels read around each window, use
+              preprocessing.crop_halo to remove them
+        flatten: if true data is returned as a (pixels, bands) array
+        normalized: if true every tile is standardized in float32 with the
+                    band statistics of the whole raster
+        statistics: band (mean, std) used instead of the raster's own ones
+        """
+        blocks = get_raster_blocks(self.org_image_path, halo, dtype, flatten,
+                                   tile_size, self.bands)
+        if not normalized:
+            return blocks
+
+        mean, std = statistics or self.get_statistics(tile_size)
+        return ((window, padded_window, standardize(data, mean, std))
+                for window, padded_window, data in blocks)
+
+    def pipeline(self, dtype=np.float32):
+        """
+        Returns a lazy RasterPipeline reading the selected bands of the
+        original image, its steps only run tile by tile when data is pulled.
+        dtype: type the tiles are read in
+        """
+        return RasterPipeline(self.org_image_path, self.bands, dtype)
+
+    def get_statistics(self, tile_size=TILE_SIZE):
+        """
+        Returns the (mean, std) of the selected bands of the original image,
+        see preprocessing.get_band_statistics
+        """
+        return get_band_statistics(self.org_image_path, self.bands,
+                                   tile_size)
 
     def get_array(self, copy=False):
         """
@@ -59,11 +169,18 @@ class RasterData():
 
     def standard_normalize_array(self, inplace=False, returnable=True):
         """
-        Normalizes the array using StandardScalar
+        Standardizes every band of the array, the result is a new float32
+        array. The cached statistics of the original image are used while
+        the array is the unmodified raster, the array's own ones once it was
+        replaced, by a blur for instance
         inplace: if true will change the objects data if false will return a
                  new normalized data and keep the object reference original
         """
-        new_data = get_normalized_bands(self.array.copy())
+        data = self.array
+        if self.is_original:
+            new_data = standardize(data, *self.get_statistics())
+        else:
+            new_data = get_normalized_bands(data.astype(np.float32))
 
         if inplace:
             self.array = new_data
@@ -79,7 +196,24 @@ class RasterData():
         inplace: if true will change the objects data if false will return a
                  new denoised data and keep the object reference original
         """
-        new_data = apply_gaussian_blur(self.array.copy(), sigma)
+        new_data = apply_gaussian_blur(self.array, sigma)
+
+        if inplace:
+            self.array = new_data
+        if returnable:
+            return new_data
+
+        return None
+
+    def denoise_array(self, radius=2, strength=3, inplace=False,
+                      returnable=True):
+        """
+        Removes noise while keeping the contours with a guided filter, see
+        preprocessing.apply_guided_filter
+        inplace: if true will change the objects data if false will return a
+                 new denoised data and keep the object reference original
+        """
+        new_data = apply_guided_filter(self.array, radius, strength)
 
         if inplace:
             self.array = new_data
@@ -90,34 +224,37 @@ class RasterData():
 
     def flatten_array(self):
         """
-        Returns a flattened data array
+        Returns a (pixels, bands) view of the data. The view shares memory
+        with the array and is cached until the array is replaced.
         """
         if len(self.array.shape) != 3:
             return self.array
 
-        flat_data = np.empty((self.height*self.width, self.shape[-1]))
-        data = self.array
-        for i in range(0, self.shape[-1]):
-            flat_band = data[:, :, i].reshape(self.width*self.height)
-            flat_data[:, i] = flat_band
+        source, flat_data = self.flat_cache
+        if source is not self.array:
+            flat_data = np.ascontiguousarray(self.array).reshape(
+                -1, self.array.shape[-1])
+            self.flat_cache = (self.array, flat_data)
 
         return flat_data
 
-    def reform_array(self, inplace=False, returnable=True):
+    def reform_array(self, inplace=False, returnable=True, data=None):
         """
         Returns a reshaped data array with original dimension
         returnable: if it returns the reshaped array
         inplace: if true will change the objects data amd return it
-                 if false will return a copy without changing the objects data
+                 if false will return a view without changing the objects data
+        data: flattened array to reshape instead of the objects data, such as
+              the labels of a clustering, (pixels,) arrays become
+              (height, width)
         """
+        if data is not None:
+            return data.reshape(self.height, self.width, *data.shape[1:])
+
         if len(self.array.shape) == 3:
             return self.array
 
-        org_data = np.empty((*self.shape))
-        data = self.array
-        for i in range(0, self.shape[2]):
-            tmp = data[:, i].reshape(self.height, self.width)
-            org_data[:, :, i] = tmp
+        org_data = self.array.reshape(self.height, self.width, -1)
 
         if inplace:
             self.array = org_data
@@ -0,0 +1,162 @@
+"""
+RasterPipeline chains the preprocessing of a raster lazily: the steps are
+only recorded until data is pulled, then every tile is read once and goes
+through all the steps before the next one is read. No intermediate copy of
+the scene is ever made. Tiles are read in order and go through the steps in
+a thread pool, the filters releasing the GIL.
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import gdal
+from scipy.ndimage import gaussian_filter
+from preprocessing import get_raster_blocks, get_band_numbers
+from preprocessing import get_band_statistics, standardize, crop_halo
+from preprocessing import TILE_SIZE
+
+
+class RasterPipeline():
+    """
+    Lazy sequence of per tile operations on the bands of a raster, steps
+    return the pipeline so that they can be chained:
+        data.pipeline().normalize().blur(5).to_array()
+    """
+    def __init__(self, image_path, bands=None, dtype=np.float32):
+        """
+        bands: band numbers or descriptions read, all if None
+        dtype: type the tiles are read in
+        """
+        self.image_path = image_path
+        raster_data = gdal.Open(image_path)
+        self.height = raster_data.RasterYSize
+        self.width = raster_data.RasterXSize
+        self.bands = get_band_numbers(raster_data, bands)
+        self.dtype = np.dtype(dtype)
+        self.steps = []
+
+    def add_step(self, function, halo=0):
+        """
+        Appends a step, function maps a (height, width, bands) tile to a new
+        one of the same size and needs halo neighbouring pixels on each side
+        to be exact.
+        """
+        self.steps.append((function, halo))
+        return self
+
+    def get_halo(self):
+        """
+        Returns the halo tiles are read with, the sum of the steps' ones.
+        """
+        return sum(halo for _, halo in self.steps)
+
+    def cast(self, dtype):
+        """
+        Converts the tiles to dtype, or reads them in it when no step was
+        added yet.
+        """
+        if not self.steps:
+            self.dtype = np.dtype(dtype)
+            return self
+        return self.add_step(lambda block: block.astype(dtype))
+
+    def select_bands(self, bands):
+        """
+        Restricts the bands read to bands, numbers or descriptions. Every
+        step works band by band so they are selected at read time.
+        """
+        self.bands = get_band_numbers(gdal.Open(self.image_path), bands)
+        return self
+
+    def normalize(self, statistics=None):
+        """
+        Standardizes every band in float32.
+        statistics: band (mean, std), those of the whole raster if None.
+                    They are computed when the pipeline runs
+        """
+        cache = {}
+        lock = threading.Lock()
+
+        def step(block):
+            with lock:
+                if 'statistics' not in cache:
+                    cache['statistics'] = statistics or get_band_statistics(
+                        self.image_path, self.bands)
+            return standardize(block, *cache['statistics'])
+
+        return self.add_step(step)
+
+    def blur(self, sigma):
+        """
+        Applies a gaussian blur of standard deviation sigma to every band.
+        """
+        def step(block):
+            blurred = np.empty(block.shape, dtype=np.float32)
+            for band in range(block.shape[-1]):
+                gaussian_filter(block[:, :, band], sigma,
+                                output=blurred[:, :, band])
+            return blurred
+
+        return self.add_step(step, int(4 * sigma + 0.5))
+
+    def mask(self, condition, fill=np.nan):
+        """
+        Replaces the pixels outside of a mask by fill.
+        condition: function of a (height, width, bands) tile returning the
+                   (height, width) boolean mask of the pixels kept
+        """
+        def step(block):
+            return np.where(condition(block)[:, :, np.newaxis], block,
+                            fill).astype(block.dtype)
+
+        return self.add_step(step)
+
+    def run_steps(self, window, padded_window, block, flatten=False):
+        """
+        Applies the steps to a tile read with the halo and returns the
+        cropped result.
+        """
+        for function, _ in self.steps:
+            block = function(block)
+        block = crop_halo(block, window, padded_window)
+        if flatten:
+            block = np.ascontiguousarray(block).reshape(-1, block.shape[-1])
+        return window, block
+
+    def iterate(self, tile_size=TILE_SIZE, flatten=False, workers=None):
+        """
+        Runs the pipeline and yields (window, data) for every tile, in
+        reading order. Tiles are read one at a time and processed in a
+        thread pool, at most twice as many tiles as threads are in memory.
+        flatten: if true data is returned as a (pixels, bands) array
+        workers: number of threads, the number of cpus if None
+        """
+        workers = workers or os.cpu_count() or 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for window, padded_window, block in get_raster_blocks(
+                    self.image_path, self.get_halo(), self.dtype,
+                    tile_size=tile_size, bands=self.bands):
+                pending.append(executor.submit(self.run_steps, window,
+                                               padded_window, block,
+                                               flatten))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def to_array(self, tile_size=TILE_SIZE, workers=None):
+        """
+        Runs the pipeline and returns the whole (height, width, bands)
+        result, the only scene sized array allocated.
+        workers: number of threads processing the tiles, see iterate
+        """
+        data = None
+        for window, block in self.iterate(tile_size, workers=workers):
+            if data is None:
+                data = np.empty((self.height, self.width, block.shape[-1]),
+                                dtype=block.dtype)
+            data[window.y_off:window.y_off + window.height,
+                 window.x_off:window.x_off + window.width] = block
+        return data
@@ -0,0 +1,163 @@
+"""
+Builds labelled training sets, such as the data/*.npy files of the labelled
+data notebook, by keeping the pixels of an image whose masks (NDWI, NDBI...)
+are above or below one of their percentiles. Scenes are processed tile by
+tile and the kept pixels are appended to disk, memory never holds more than
+a tile.
+"""
+import os
+import shutil
+from math import ceil
+import numpy as np
+import gdal
+from preprocessing import get_block_windows, get_raster_blocks, read_window
+from preprocessing import Window, TILE_SIZE
+
+# Number of bins of the histograms percentiles are approximated with
+QUANTILE_BINS = 4096
+
+# Comparisons a mask can be thresholded with
+OPERATORS = {'<': np.less, '>': np.greater}
+
+# Number of bytes copied at once when writing the final .npy file
+COPY_BYTES = 64 * 1024 ** 2
+
+
+def get_value_range(image_path, tile_size=TILE_SIZE):
+    """
+    Returns the (min, max) of the first band of the raster ignoring nan
+    values, computed in a streaming pass.
+    """
+    low, high = np.inf, -np.inf
+    for _, _, data in get_raster_blocks(image_path, tile_size=tile_size,
+                                        bands=[1]):
+        data = data[np.isfinite(data)]
+        if data.size:
+            low, high = min(low, data.min()), max(high, data.max())
+    return low, high
+
+
+def get_percentile(image_path, percentile, value_range=None,
+                   bins=QUANTILE_BINS, tile_size=TILE_SIZE):
+    """
+    Approximates a percentile of the first band of the raster from a fixed
+    range histogram accumulated tile by tile, the error is at most the
+    width of a bin.
+    value_range: (min, max) of the histogram, such as (-1, 1) for normalized
+                 differences. Found with an extra pass over the raster if
+                 None
+    """
+    if value_range is None:
+        value_range = get_value_range(image_path, tile_size)
+
+    counts = np.zeros(bins, dtype=np.int64)
+    for _, _, data in get_raster_blocks(image_path, tile_size=tile_size,
+                                        bands=[1]):
+        data = data[np.isfinite(data)]
+        counts += np.histogram(data, bins, value_range)[0]
+
+    edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    cumulative = np.cumsum(counts)
+    rank = percentile / 100 * cumulative[-1]
+    index = min(np.searchsorted(cumulative, rank), bins - 1)
+    below = cumulative[index] - counts[index]
+    fraction = (rank - below) / max(counts[index], 1)
+    return edges[index] + fraction * (edges[index + 1] - edges[index])
+
+
+def read_mask_window(mask_data, window, factor):
+    """
+    Reads the window of a 10m grid from a mask whose pixels are factor times
+    bigger, by reading the matching window of the mask and repeating its
+    pixels, as a (height, width) array.
+    """
+    x_off, y_off = window.x_off // factor, window.y_off // factor
+    x_end = min(mask_data.RasterXSize,
+                ceil((window.x_off + window.width) / factor))
+    y_end = min(mask_data.RasterYSize,
+                ceil((window.y_off + window.height) / factor))
+    mask = read_window(mask_data, Window(x_off, y_off, x_end - x_off,
+                                         y_end - y_off), bands=[1])[:, :, 0]
+    mask = mask.repeat(factor, axis=0).repeat(factor, axis=1)
+
+    top = window.y_off - y_off * factor
+    left = window.x_off - x_off * factor
+    mask = mask[top:top + window.height, left:left + window.width]
+    return np.pad(mask, ((0, window.height - mask.shape[0]),
+                         (0, window.width - mask.shape[1])), mode='edge')
+
+
+def extract_scene(raw_file, image_path, conditions, dtype=np.uint8,
+                  tile_size=TILE_SIZE):
+    """
+    Appends to the open raw file the pixels of the image meeting every
+    condition and not holding a zero band, and returns their number.
+    conditions: list of (mask_path, operator, percentile) tuples, such as
+                ('water_NDWI.tiff', '>', 70), operator being '<' or '>'.
+                Masks can be on a coarser grid than the image
+    """
+    image_data = gdal.Open(image_path)
+    masks = []
+    for mask_path, operator, percentile in conditions:
+        mask_data = gdal.Open(mask_path)
+        factor = int(round(image_data.RasterXSize / mask_data.RasterXSize))
+        masks.append((mask_data, factor, OPERATORS[operator],
+                      get_percentile(mask_path, percentile,
+                                     tile_size=tile_size)))
+
+    rows = 0
+    for window, _ in get_block_windows(image_data, tile_size=tile_size):
+        pixels = read_window(image_data, window, dtype)
+        keep = np.all(pixels, axis=2)
+        for mask_data, factor, operator, threshold in masks:
+            keep &= operator(read_mask_window(mask_data, window, factor),
+                             threshold)
+
+        selected = pixels[keep]
+        raw_file.write(selected.tobytes())
+        rows += len(selected)
+
+    return rows
+
+
+def extract_samples(output_path, scenes, dtype=np.uint8,
+                    tile_size=TILE_SIZE):
+    """
+    Builds a .npy file of shape (pixels, bands) from the pixels kept in
+    every scene, see extract_scene. Pixels are appended to a raw file while
+    the scenes are processed and the .npy header is only written at the
+    end, once their number is known. Returns the number of pixels.
+    scenes: list of (image_path, conditions) tuples
+    """
+    dtype = np.dtype(dtype)
+    raw_path = output_path + '.raw'
+    rows = 0
+    bands = None
+    with open(raw_path, 'wb') as raw_file:
+        for image_path, conditions in scenes:
+            count = gdal.Open(image_path).RasterCount
+            if bands is not None and count != bands:
+                raise ValueError('{} has {} bands instead of {}'.format(
+                    image_path, count, bands))
+            bands = count
+            rows += extract_scene(raw_file, image_path, conditions, dtype,
+                                  tile_size)
+
+    try:
+        write_npy(raw_path, output_path, (rows, bands or 0), dtype)
+    finally:
+        os.remove(raw_path)
+    return rows
+
+
+def write_npy(raw_path, output_path, shape, dtype):
+    """
+    Writes a .npy file holding the C ordered array of the given shape and
+    type stored in a raw file, copying it in chunks.
+    """
+    header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+              'fortran_order': False, 'shape': shape}
+    with open(output_path, 'wb') as npy_file:
+        np.lib.format.write_array_header_1_0(npy_file, header)
+        with open(raw_path, 'rb') as raw_file:
+            shutil.copyfileobj(raw_file, npy_file, COPY_BYTES)
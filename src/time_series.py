@@ -0,0 +1,102 @@
+"""
+Time series of the classes covering a project: every downloaded date is
+classified with a CentroidClassifier and the fraction of the scene covered
+by each class is written to a single table.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from centroid_classifier import CentroidClassifier
+from project_manager import ProjectManager, report_progress
+from raster_data import RasterData
+from preprocessing import TILE_SIZE
+
+# Index of each resolution in the list returned by get_band_paths
+RESOLUTIONS = {10: 0, 20: 1, 60: 2}
+
+
+def count_classes(classifier, image_path, bands=None, tile_size=TILE_SIZE):
+    """
+    Returns the number of pixels of the image labelled with each class, as
+    an array indexed by label. The image is classified tile by tile and only
+    the histogram of every tile is kept.
+    bands: band numbers or descriptions used as features, all if None
+    """
+    counts = np.zeros(256, dtype=np.int64)
+    data = RasterData(image_path, bands=bands)
+    for _, _, features in data.iterate_blocks(dtype=np.float32, flatten=True,
+                                              tile_size=tile_size):
+        counts += np.bincount(classifier.predict(features), minlength=256)
+    return counts
+
+
+def class_fractions(project, classifier, band='TCI', resolution=10,
+                    workers=1, bands=None, tile_size=TILE_SIZE):
+    """
+    Classifies the band of every downloaded date of the project, dates
+    being processed concurrently, and returns a table with one row per date
+    and class holding its number of pixels and the fraction of the scene it
+    covers. Dates that fail are reported and left out of the table.
+    band: name of the band file classified, such as 'TCI' or 'B08'
+    resolution: resolution in meters of the band, 10, 20 or 60
+    workers: number of processes classifying dates concurrently
+    """
+    paths = {}
+    for date in project.get_dates():
+        paths[date] = project.get_band_paths(date)[
+            RESOLUTIONS[resolution]][band]
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(count_classes, classifier, image_path,
+                                   bands, tile_size): date
+                   for date, image_path in paths.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            date = futures[future]
+            try:
+                counts = future.result()
+            except Exception as error:
+                report_progress(done, len(futures), date, error)
+                continue
+
+            report_progress(done, len(futures), date)
+            for label in classifier.classes:
+                rows.append({'date': date, 'class': int(label),
+                             'pixels': int(counts[label]),
+                             'fraction': counts[label] / counts.sum()})
+
+    table = pd.DataFrame(rows, columns=['date', 'class', 'pixels',
+                                        'fraction'])
+    return table.sort_values(['date', 'class']).reset_index(drop=True)
+
+
+def main():
+    """
+    Command line entry point, writes the class fractions of a project to a
+    csv file.
+    """
+    parser = argparse.ArgumentParser(
+        description='Per date class fractions of a project.')
+    parser.add_argument('project', help='name of the project')
+    parser.add_argument('classifier',
+                        help='.npz file saved by CentroidClassifier.save')
+    parser.add_argument('output', help='csv file the table is written to')
+    parser.add_argument('--band', default='TCI',
+                        help='band file classified (default: TCI)')
+    parser.add_argument('--resolution', type=int, default=10,
+                        choices=sorted(RESOLUTIONS),
+                        help='resolution of the band in meters')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of dates processed concurrently')
+    args = parser.parse_args()
+
+    project = ProjectManager(args.project)
+    classifier = CentroidClassifier.load(args.classifier)
+    table = class_fractions(project, classifier, args.band, args.resolution,
+                            args.workers)
+    table.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()